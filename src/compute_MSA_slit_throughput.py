@@ -5,132 +5,255 @@ import numpy as np
 from astropy.io import fits
 from scipy import interpolate
 import re
+import zlib
 
-def isclose(a, b, rel_tol=1e-07, abs_tol=0.0):
-    return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+# Version of the layout of the compiled throughput grid. The compiled grid is a
+# single (memory-mappable) .npy file containing a 1D float64 array with
+# [version, nx, ny, nz, files hash, x (Sersic), y (r_eff), z (wl), throughput[nx,ny,nz]]
+compiled_grid_version = 2
+header_size = 5
 
-class MSAThroughput(object):
+def unique_in_order(a):
+    """ Unique elements of the array `a`, in order of first appearance """
 
-    def __init__(self, folder, aperture_type="OPEN", throughput_type="relative"):
+    _, indices = np.unique(a, return_index=True)
 
-        aperture_types = ("PITCH", "OPEN", "MID", "CONST", "TIGHT")
-        if aperture_type not in aperture_types:
-             raise Exception('Aperture type`' + aperture_type + '` not supported!')
+    return np.asarray(a)[np.sort(indices)]
+
+def list_throughput_files(folder, aperture_type="OPEN"):
+
+    file_list = list()
+
+    for file in sorted(os.listdir(folder)):
+        if file.endswith(".fits") and aperture_type in file:
+            file_list.append(file)
+
+    return file_list
+
+def get_compiled_grid_name(folder, aperture_type="OPEN", throughput_type="relative"):
+
+    return os.path.join(folder, "slit_losses_" + aperture_type + "_" + throughput_type + ".npy")
+
+def read_throughput_grid(folder, file_list, throughput_type="relative"):
+    """ 
+    Read the (Sersic x r_eff x wavelength) throughput cube from the FITS
+    files produced by M. Maseda
+
+    Returns
+    -------
+    x, y, z, throughput : numpy arrays
+        Sersic indices, effective radii (arcsec), wavelengths (micron) and
+        throughput cube of shape (x.size, y.size, z.size)
+    """
+
+    sersic = list()
+    for file in file_list:
+        f = file.split('_')[0]
+        f = map(int, re.findall('\d+', f))
+        sersic.append(f[0])
+
+    x = np.array(sersic)
+    cube = None
+
+    for ix, file in enumerate(file_list):
+
+        full_path = os.path.join(folder, file)
+        hdulist = fits.open(full_path)
+
+        wl = hdulist[1].data["wavelength"]
+        z = unique_in_order(wl)*1.E+06
+        r_eff = hdulist[1].data["r_eff"]
+        if throughput_type == "relative":
+            throughput = hdulist[1].data["correctedthroughput"]
+        elif throughput_type == "total":
+            throughput = hdulist[1].data["throughput"]
+        else:
+            raise ValueError('Throughput type `' + throughput_type + '` not supported!')
+
+        y = unique_in_order(r_eff)
+
+        if cube is None:
+            cube = np.zeros((x.size, y.size, z.size))
+
+        for iy, r in enumerate(y):
+            ok = np.where(r_eff == r)[0]
+            cube[ix,iy,:] = throughput[ok]
+
+        hdulist.close()
+
+    return x, np.array(y), np.array(z), cube
+
+def get_files_hash(folder, file_list):
+    """ 
+    Hash (CRC32) of the sorted names and sizes of the FITS files the grid is
+    built from, so that renamed, swapped or replaced files are detected
+    """
+
+    files = ""
+    for file in sorted(file_list):
+        files += file + ":" + str(os.path.getsize(os.path.join(folder, file))) + ";"
 
-        file_list = list()
+    return zlib.crc32(files) & 0xffffffff
 
-        # Read in the model
-        for file in sorted(os.listdir(folder)):
-            if file.endswith(".fits") and aperture_type in file:
-                file_list.append(file)
+def is_compiled_grid_up_to_date(compiled_file, folder, file_list):
+    """ 
+    The compiled grid is up to date if it is newer than all the FITS files
+    it was built from, and it was built from the same files (same names and
+    sizes)
+    """
 
-        sersic = list()
-        for file in file_list:
-            f = file.split('_')[0]
-            f = map(int, re.findall('\d+', f))
-            sersic.append(f[0])
+    if not os.path.isfile(compiled_file):
+        return False
 
-        self.throughput = None
+    mtime = os.path.getmtime(compiled_file)
+    for file in file_list:
+        if os.path.getmtime(os.path.join(folder, file)) > mtime:
+            return False
 
-        self.x = np.array(sersic)
+    header = np.load(compiled_file, mmap_mode='r')[0:header_size]
+    if int(header[0]) != compiled_grid_version or int(header[1]) != len(file_list):
+        return False
 
-        for ix, file in enumerate(file_list):
+    if int(header[4]) != get_files_hash(folder, file_list):
+        return False
 
-            #print "file: ", file
+    return True
 
-            full_path = os.path.join(folder, file)
-            hdulist = fits.open(full_path)
+def write_compiled_grid(compiled_file, x, y, z, throughput, files_hash):
 
-            wl = hdulist[1].data["wavelength"]
-            unique_wl = reduce(lambda l, x: l if x in l else l+[x], wl, [])
-            self.z = np.array(unique_wl)*1.E+06
-            r_eff = hdulist[1].data["r_eff"]
-            if throughput_type == "relative":
-                throughput = hdulist[1].data["correctedthroughput"]
-            elif throughput_type == "total":
-                throughput = hdulist[1].data["throughput"]
-    
-            unique_r_eff = reduce(lambda l, x: l if x in l else l+[x], r_eff, [])
+    grid = np.concatenate((
+        np.array([compiled_grid_version, x.size, y.size, z.size, files_hash], dtype=np.float64),
+        x, y, z, np.ravel(throughput)
+        ))
 
-            self.y = np.array(unique_r_eff)
+    # Write to a temporary file first and then rename it, so that concurrent
+    # simulations never read a partially written grid
+    tmp_file = compiled_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, grid)
+    os.rename(tmp_file, compiled_file)
 
-            if self.throughput is None:
-                self.throughput = np.zeros((self.x.size, self.y.size, self.z.size))
-            
-            for iy, r in enumerate(unique_r_eff):
-                ok = np.where(r_eff == r)[0]
-                t = throughput[ok]
-                    
-                self.throughput[ix,iy,:] = t    
-                #print "ix, iy: ", ix, iy
-                #print "throughput: ", t
+def load_compiled_grid(compiled_file):
 
-            hdulist.close()
+    grid = np.load(compiled_file, mmap_mode='r')
+    nx, ny, nz = (int(n) for n in grid[1:4])
+
+    i = header_size
+    x = grid[i:i+nx] ; i += nx
+    y = grid[i:i+ny] ; i += ny
+    z = grid[i:i+nz] ; i += nz
+    throughput = grid[i:i+nx*ny*nz].reshape((nx, ny, nz))
+
+    return x, y, z, throughput
+
+def compile_throughput_grid(folder, aperture_type="OPEN", throughput_type="relative", 
+        compiled_file=None):
+    """ 
+    One-time conversion of the FITS files in `folder` into a single compiled
+    grid, which is then automatically used by MSAThroughput
+    """
+
+    if compiled_file is None:
+        compiled_file = get_compiled_grid_name(folder, aperture_type, throughput_type)
+
+    file_list = list_throughput_files(folder, aperture_type)
+    x, y, z, throughput = read_throughput_grid(folder, file_list, throughput_type)
+    write_compiled_grid(compiled_file, x, y, z, throughput, get_files_hash(folder, file_list))
+
+    return compiled_file
+
+class MSAThroughput(object):
+
+    def __init__(self, folder, aperture_type="OPEN", throughput_type="relative", 
+            compiled_file=None):
+
+        aperture_types = ("PITCH", "OPEN", "MID", "CONST", "TIGHT")
+        if aperture_type not in aperture_types:
+             raise Exception('Aperture type`' + aperture_type + '` not supported!')
+
+        file_list = list_throughput_files(folder, aperture_type)
+
+        if compiled_file is None:
+            compiled_file = get_compiled_grid_name(folder, aperture_type, throughput_type)
+
+        # Use the compiled grid if present and up to date, otherwise read in
+        # the model from the FITS files and (try to) compile it for the next
+        # time
+        if is_compiled_grid_up_to_date(compiled_file, folder, file_list):
+            self.x, self.y, self.z, self.throughput = load_compiled_grid(compiled_file)
+        else:
+            self.x, self.y, self.z, self.throughput = read_throughput_grid(folder, 
+                    file_list, throughput_type)
+            try:
+                write_compiled_grid(compiled_file, self.x, self.y, self.z, self.throughput,
+                        get_files_hash(folder, file_list))
+            except (IOError, OSError):
+                pass
 
         self.abscissa = (self.x, self.y, self.z)
 
+    def _check_range(self, values, grid, name):
+
+        values = np.atleast_1d(values)
+
+        low = (values < grid[0]) & ~np.isclose(values, grid[0], rtol=1e-07, atol=0.)
+        if np.any(low):
+            raise ValueError('Input ' + name + ' cannot be < ' + str(grid[0]) + '!')
+
+        high = (values > grid[-1]) & ~np.isclose(values, grid[-1], rtol=1e-07, atol=0.)
+        if np.any(high):
+            raise ValueError('Input ' + name + ' cannot be > ' + str(grid[-1]) + '!')
+
     def get_throughput(self, wl, Sersic=4, effective_radius=0.1):
 
-        if isclose(Sersic, self.x[0]) or isclose(Sersic, self.x[-1]):
-            pass
-        elif Sersic < self.x[0]:
-            raise ValueError('Input Sersic index cannot be < ' + str(self.x[0]) + '!')
-        elif Sersic > self.x[-1]:
-            raise ValueError('Input Sersic index cannot be > ' + str(self.x[-1]) + '!')
-
-        if isclose(effective_radius, self.y[0]) or isclose(effective_radius, self.y[-1]):
-            pass
-        elif effective_radius < self.y[0]:
-            raise ValueError('Input effective radius cannot be < ' + str(self.y[0]) + '!')
-        elif effective_radius > self.y[-1]:
-            raise ValueError('Input effective radius cannot be > ' + str(self.y[-1]) + '!')
-
-        # Linear interpolate at the right Sersic index
-        iy = np.searchsorted(self.y, effective_radius)
-        ix = np.searchsorted(self.x, Sersic)
-
-        if isclose(Sersic, self.x[ix]):
-            if isclose(effective_radius, self.y[iy]):
-                fy = self.throughput[ix,iy,:]
-            else:
-                fy = (self.y[iy+1]-effective_radius)/(self.y[iy+1]-self.y[iy])*self.throughput[ix,iy,:] \
-                        + (effective_radius-self.y[iy])/(self.y[iy+1]-self.y[iy])*self.throughput[ix,iy+1,:]
-        else:
-            if isclose(effective_radius, self.y[iy]):
-                fy = (self.x[ix+1]-Sersic)/(self.x[ix+1]-self.x[ix])*self.throughput[ix,iy,:] \
-                        + (Sersic-self.x[ix])/(self.x[ix+1]-self.x[ix])*self.throughput[ix+1,iy,:]
-            else:
-                fy1 = (self.x[ix+1]-Sersic)/(self.x[ix+1]-self.x[ix])*self.throughput[ix,iy,:] \
-                        + (Sersic-self.x[ix])/(self.x[ix+1]-self.x[ix])*self.throughput[ix+1,iy,:]
+        return self.get_throughput_batch(wl, Sersic=(Sersic,), 
+                effective_radius=(effective_radius,))[0,:]
+
+    def get_throughput_batch(self, wl, Sersic, effective_radius):
+        """ 
+        Throughput for many sources at once
+
+        Parameters
+        ----------
+        wl : numpy array
+            Wavelengths (in micron) where the throughput is computed
+
+        Sersic : float or numpy array
+            Sersic index of each source (a single value is used for all sources)
 
-                fy2 = (self.x[ix+1]-Sersic)/(self.x[ix+1]-self.x[ix])*self.throughput[ix,iy+1,:] \
-                        + (Sersic-self.x[ix])/(self.x[ix+1]-self.x[ix])*self.throughput[ix+1,iy+1,:]
+        effective_radius : float or numpy array 
+            Effective radius (in arcsec) of each source, e.g. as returned by
+            `Shibuya_sizes` (astropy Quantity are accepted)
 
-                fy = (self.y[iy+1]-effective_radius)/(self.y[iy+1]-self.y[iy])*fy1 \
-                        + (effective_radius-self.y[iy])/(self.y[iy+1]-self.y[iy])*fy2
+        Returns
+        -------
+        throughput : numpy array
+            2D array of shape (n_sources, len(wl))
+        """
 
+        wl = np.atleast_1d(wl)
+        effective_radius = np.atleast_1d(getattr(effective_radius, 'value', effective_radius))
+        Sersic, effective_radius = np.broadcast_arrays(np.atleast_1d(Sersic), effective_radius)
 
-        f = interpolate.interp1d(self.z, fy, kind='cubic')
-    
-        # Avoid extrapolation errors
-        i0=0
-        i1=len(wl)+1
-        f_wl = np.zeros(len(wl))
-        if wl[0] < self.z[0]:
-            i0 = np.searchsorted(wl, self.z[0])
+        self._check_range(Sersic, self.x, 'Sersic index')
+        self._check_range(effective_radius, self.y, 'effective radius')
 
-        if wl[-1] > self.z[-1]:
-            i1 = np.searchsorted(wl, self.z[-1])
+        # Bilinear interpolation at the (Sersic, effective_radius) of each source
+        ix = np.clip(np.searchsorted(self.x, Sersic)-1, 0, self.x.size-2)
+        wx = np.clip((Sersic-self.x[ix])/(self.x[ix+1]-self.x[ix]), 0., 1.)[:,np.newaxis]
 
-        f_wl[i0:i1] = f(wl[i0:i1])
+        iy = np.clip(np.searchsorted(self.y, effective_radius)-1, 0, self.y.size-2)
+        wy = np.clip((effective_radius-self.y[iy])/(self.y[iy+1]-self.y[iy]), 0., 1.)[:,np.newaxis]
 
-        if wl[0] < self.z[0]:
-            f_wl[0:i0] = f(self.z[0])
+        fy = (1.-wx)*(1.-wy)*self.throughput[ix,iy,:] + wx*(1.-wy)*self.throughput[ix+1,iy,:] \
+                + (1.-wx)*wy*self.throughput[ix,iy+1,:] + wx*wy*self.throughput[ix+1,iy+1,:]
 
-        if wl[-1] > self.z[-1]:
-            f_wl[i1:] = f(self.z[-1])
+        # Cubic interpolation in wavelength, for all sources at once. Outside
+        # the tabulated range the throughput is kept constant, to avoid
+        # extrapolation errors
+        f = interpolate.interp1d(self.z, fy, kind='cubic', axis=1)
 
-        return f_wl
+        return f(np.clip(wl, self.z[0], self.z[-1]))
 
         #grid_z2 = griddata(points, values, (sersic, effective_radius, wl), method='cubic')
 
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import argparse
+import os
+import json
+from astropy.io import fits
+import numpy as np
+
+from pathos.multiprocessing import ProcessingPool
+
+from compute_emission_line_SN import get_cumulative_integrals, integrate_window, read_spectra_cube, \
+        list_simulated_spectra, get_MC_draw
+
+def get_band_windows(diagnostics):
+    """
+    Collect the rest-frame windows used by the continuum diagnostics of a
+    JSON configuration, so that all of them are integrated at once
+
+    Returns
+    -------
+    windows : numpy array
+        Array of shape (n_windows, 2) with the distinct windows (Ang)
+
+    indices : OrderedDict
+        For each diagnostic, the indices of its windows in `windows`
+    """
+
+    windows = list()
+    indices = OrderedDict()
+
+    for key, value in diagnostics.iteritems():
+        if value["type"] == "slope":
+            _windows = value["windows"]
+        elif value["type"] == "ratio":
+            _windows = [value["blue"], value["red"]]
+        elif value["type"] == "SN":
+            _windows = [value["window"]]
+        else:
+            raise ValueError("Continuum diagnostic `" + key + "` of unknown type `" + value["type"] + "`")
+
+        indices[key] = list()
+        for window in _windows:
+            window = tuple(window)
+            if window not in windows:
+                windows.append(window)
+            indices[key].append(windows.index(window))
+
+    return np.array(windows, dtype=np.float64).reshape(-1, 2), indices
+
+def measure_bands(wl, minw, maxw, dwl, fluxes, errors, redshift, windows, cumul=None, cumul_nu=None):
+    """
+    Average flux density of a spectrum (or of a cube of spectra sharing the
+    same wavelength grid) in several rest-frame windows at once, using the
+    cumulative integrals of the spectrum
+
+    Parameters
+    ----------
+    wl, minw, maxw, dwl : numpy arrays
+        Central, minimum, maximum wavelength and width of each pixel (Ang)
+
+    fluxes, errors : numpy arrays
+        Flux and flux error (F_lambda), either 1D or 2D (n_objects x n_wl)
+
+    redshift : float or numpy array
+        Redshift of the spectrum, or of each object of the cube
+
+    windows : numpy array
+        Rest-frame windows, of shape (n_windows, 2)
+
+    cumul, cumul_nu : dict, optional
+        Cumulative integrals of F_lambda and of F_lambda*wl^2 (i.e. F_nu up
+        to a constant), as returned by `get_cumulative_integrals`
+
+    Returns
+    -------
+    bands : OrderedDict
+        Average F_lambda ("flux") and F_lambda*wl^2 ("flux_nu") with their
+        errors ("flux_err", "flux_nu_err"), the average rest-frame wavelength
+        ("wl") and whether each window is covered by the spectrum
+        ("covered"), with shape (n_windows,) or (n_objects, n_windows)
+    """
+
+    if cumul is None:
+        cumul = get_cumulative_integrals(wl, dwl, fluxes, errors)
+    if cumul_nu is None:
+        cumul_nu = get_cumulative_integrals(wl, dwl, fluxes*wl**2, errors*wl**2)
+
+    cube = np.ndim(fluxes) == 2
+    z1 = 1.+np.reshape(redshift, (-1, 1))
+
+    # Pixels whose centre falls in each window
+    _windows = windows * z1[:,:,np.newaxis]
+    i0 = np.searchsorted(wl, _windows[...,0])
+    i1 = np.searchsorted(wl, _windows[...,1]) - 1
+    covered = (_windows[...,0] >= minw[0]) & (_windows[...,1] <= maxw[-1]) & (i1 >= i0)
+
+    if not cube:
+        cumul = OrderedDict((key, np.atleast_2d(value)) if key in ("flux", "variance")
+                else (key, value) for key, value in cumul.iteritems())
+        cumul_nu = OrderedDict((key, np.atleast_2d(value)) if key in ("flux", "variance")
+                else (key, value) for key, value in cumul_nu.iteritems())
+
+    bands = OrderedDict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        width = integrate_window(cumul["dwl"], i0, i1)
+        for key, c in (("flux", cumul), ("flux_nu", cumul_nu)):
+            bands[key] = np.where(covered, integrate_window(c["flux"], i0, i1) / width, np.nan)
+            bands[key + "_err"] = np.where(covered, np.sqrt(integrate_window(c["variance"], i0, i1)) / width, np.nan)
+        bands["wl"] = np.where(covered, integrate_window(cumul["wl"], i0, i1) / width / z1, np.nan)
+    bands["covered"] = covered
+
+    if not cube:
+        for key, value in bands.iteritems():
+            bands[key] = value[0,:]
+
+    return bands
+
+def fit_power_law(wl, flux, flux_err):
+    """
+    Weighted least-squares fit of ln(flux) = beta*ln(wl) + const along the
+    last axis, ignoring the NaN and non-positive fluxes
+
+    Returns
+    -------
+    beta, beta_err : numpy arrays
+        Slope and its error, NaN where fewer than two points are available
+    """
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        valid = np.isfinite(flux) & (flux > 0.) & (flux_err > 0.)
+        x = np.where(valid, np.log(wl), 0.)
+        y = np.where(valid, np.log(flux), 0.)
+        w = np.where(valid, (flux/flux_err)**2, 0.)
+
+        S, Sx, Sy = np.sum(w, axis=-1), np.sum(w*x, axis=-1), np.sum(w*y, axis=-1)
+        Sxx, Sxy = np.sum(w*x*x, axis=-1), np.sum(w*x*y, axis=-1)
+        delta = S*Sxx - Sx**2
+
+        ok = (np.sum(valid, axis=-1) >= 2) & (delta > 0.)
+        beta = np.where(ok, (S*Sxy - Sx*Sy) / delta, np.nan)
+        beta_err = np.where(ok, np.sqrt(S / delta), np.nan)
+
+    return beta, beta_err
+
+def compute_diagnostics(bands, diagnostics, indices):
+    """
+    Continuum diagnostics from the average fluxes in the windows returned by
+    `measure_bands`: power-law slopes ("slope", e.g. the UV slope beta),
+    ratios of the average F_nu (or F_lambda, if "units" is "lambda") in a
+    red and a blue window ("ratio", e.g. D4000 and the Balmer break), and the
+    S/N of the continuum integrated over a window ("SN", with unit error)
+
+    Returns
+    -------
+    values : OrderedDict
+        For each diagnostic, its value and error, with -99.99 where it
+        cannot be measured
+    """
+
+    values = OrderedDict()
+    for key, value in diagnostics.iteritems():
+        index = indices[key]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if value["type"] == "slope":
+                v, err = fit_power_law(bands["wl"][...,index], bands["flux"][...,index],
+                        bands["flux_err"][...,index])
+
+            elif value["type"] == "ratio":
+                flux = "flux" if value.get("units", "nu") == "lambda" else "flux_nu"
+                blue, red = bands[flux][...,index[0]], bands[flux][...,index[1]]
+                blue_err, red_err = bands[flux + "_err"][...,index[0]], bands[flux + "_err"][...,index[1]]
+                v = red / blue
+                err = np.abs(v) * np.sqrt((red_err/red)**2 + (blue_err/blue)**2)
+                ok = (blue > 0.)
+                v, err = np.where(ok, v, np.nan), np.where(ok, err, np.nan)
+
+            elif value["type"] == "SN":
+                v = bands["flux"][...,index[0]] / bands["flux_err"][...,index[0]]
+                err = np.where(np.isfinite(v), 1., np.nan)
+
+        values[key] = (np.where(np.isfinite(v), v, -99.99), np.where(np.isfinite(err), err, -99.99))
+
+    return values
+
+def measure_continuum_chunk(file_names, diagnostics):
+    """
+    Continuum diagnostics of a list of simulated spectra, measuring at once
+    all the spectra sharing the same filter/grating configuration
+
+    Returns
+    -------
+    measurements : list
+        For each spectrum, an OrderedDict with the value and error of each
+        diagnostic
+    """
+
+    windows, indices = get_band_windows(diagnostics)
+
+    setups = OrderedDict()
+    for i, file_name in enumerate(file_names):
+        setup = "_".join(os.path.splitext(file_name)[0].split('_')[-2:])
+        setups.setdefault(setup, list()).append(i)
+
+    measurements = [None] * len(file_names)
+    for setup, _indices in setups.iteritems():
+        spectra = read_spectra_cube([file_names[i] for i in _indices])
+
+        bands = measure_bands(spectra["wl"], spectra["minw"], spectra["maxw"], spectra["dwl"],
+                spectra["fluxes"], spectra["errors"], spectra["redshift"], windows)
+
+        values = compute_diagnostics(bands, diagnostics, indices)
+
+        for j, i in enumerate(_indices):
+            measurements[i] = OrderedDict((key, (v[j], err[j])) for key, (v, err) in values.iteritems())
+
+    return measurements
+
+def get_output_file_name(folder):
+
+    return os.path.join(folder, "Continuum_diagnostics_MC_" + get_MC_draw(folder) + ".fits")
+
+def write_continuum_diagnostics(file_name, IDs, filters, gratings, diagnostics, measurements):
+
+    cols = list()
+
+    cols.append(fits.Column(name='ID', format='20A', array=IDs))
+    cols.append(fits.Column(name='filter', format='20A', array=filters))
+    cols.append(fits.Column(name='grating', format='20A', array=gratings))
+
+    for key in diagnostics:
+        data = np.array([m[key][0] for m in measurements])
+        cols.append(fits.Column(name=str(key), format='E', array=data))
+        data = np.array([m[key][1] for m in measurements])
+        cols.append(fits.Column(name=str(key) + "_err", format='E', array=data))
+
+    new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+    new_hdu.name = 'CONTINUUM'
+
+    new_hdulist = fits.HDUList([fits.PrimaryHDU(), new_hdu])
+    new_hdulist.writeto(file_name, overwrite=True)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--folder',
+        help="Parent folder(s) containing the NIRSpec simulations",
+        dest="folders",
+        type=str,
+        nargs='+',
+        required=True
+    )
+
+    parser.add_argument(
+        '--json-file',
+        help="JSON file containing the continuum diagnostics (UV slope, breaks, S/N of the continuum)",
+        dest="json_file",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "continuum_diagnostics_config.json")
+    )
+
+    parser.add_argument(
+        '--nproc',
+        help="Number of processors to use",
+        action="store",
+        type=int,
+        dest="nproc",
+        default=-1
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        help="Number of spectra processed by each parallel task",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=50
+    )
+
+    args = parser.parse_args()
+
+    with open(args.json_file) as f:
+        diagnostics = json.load(f, object_pairs_hook=OrderedDict)
+
+    # Spectra of all folders, processed together
+    simulations = OrderedDict()
+    file_names = list()
+    for folder in args.folders:
+        _file_names, IDs, filters, gratings = list_simulated_spectra(folder)
+        simulations[folder] = (_file_names, IDs, filters, gratings)
+        file_names += _file_names
+
+    chunks = [file_names[i:i+args.chunk_size] for i in range(0, len(file_names), args.chunk_size)]
+
+    if args.nproc <= 0:
+        results = [measure_continuum_chunk(chunk, diagnostics) for chunk in chunks]
+    else:
+        # Set number of parellel processes to use
+        pool = ProcessingPool(nodes=args.nproc)
+
+        results = pool.map(measure_continuum_chunk, chunks, (diagnostics,)*len(chunks))
+
+    measured = dict(zip(file_names, [m for result in results for m in result]))
+
+    for folder, (_file_names, IDs, filters, gratings) in simulations.iteritems():
+        measurements = [measured[f] for f in _file_names]
+        print "Folder ", folder, ": ", len(_file_names), " spectra measured"
+        write_continuum_diagnostics(get_output_file_name(folder), IDs, filters, gratings,
+                diagnostics, measurements)
@@ -3,11 +3,35 @@
 from collections import OrderedDict
 import argparse
 import os
-from natsort import natsorted, ns
 import json
 from astropy.io import fits
 from bisect import bisect_left
 import numpy as np
+import zlib
+from functools import partial
+
+from pathos.multiprocessing import ProcessingPool 
+
+from fit_emission_lines import fit_lines, get_line_templates, read_line_components, read_resolution_curve
+from simulations_index import get_simulations_index, parse_file_name
+
+c_light = 2.99792e+18 # Ang/s
+
+# Quantities measured for each line
+line_quantities = ("flux", "flux_err", "continuum", "EW", "SN")
+
+# Percentiles of the S/N distribution computed from Monte Carlo noise realizations
+MC_percentiles = (16., 50., 84.)
+
+# Default measurement options: whether the lines are measured on the
+# noiseless spectrum (expected S/N) rather than on the noisy one, number of
+# Monte Carlo noise realizations (0 to skip them), S/N threshold for the
+# detection probability, seed of the random number generator, and the
+# settings of the line fitting (None to integrate the lines over their
+# windows), i.e. a dict with the "components" of the lines, the
+# "resolution" curve and the "redshift_step" (see fit_emission_lines.py)
+default_options = {"expected": False, "MC_draws": 0, "SN_threshold": 3., "seed": 123456,
+        "fit": None}
 
 def get_line_SN_OLD(file_name, line_wl):
 
@@ -108,131 +132,717 @@ def get_line_SN_OLD(file_name, line_wl):
     return SN, SN_1pixel
 
 
-def get_lines_SN(file_name, lines):
+def get_line_windows(lines):
+    """ 
+    Put the rest-frame windows of the lines in a JSON configuration into
+    arrays of shape (n_lines, 2), with NaN where a continuum window is not
+    defined. The central wavelength, where the continuum is evaluated, is the
+    centre of "wl_range" if "wl_central" is not defined.
+    """
 
+    n = len(lines)
 
-    #print "file_name: ", file_name
+    windows = OrderedDict()
+    windows["wl_range"] = np.zeros((n, 2))
+    windows["continuum_left"] = np.full((n, 2), np.nan)
+    windows["continuum_right"] = np.full((n, 2), np.nan)
+    windows["wl_central"] = np.zeros(n)
 
-    hdulist = fits.open(file_name)
-    redshift = hdulist[1].header['redshift']
+    for i, value in enumerate(lines.itervalues()):
+        for key in windows:
+            if key in value:
+                windows[key][i] = value[key]
+        if "wl_central" not in value:
+            windows["wl_central"][i] = 0.5*(value["wl_range"][0]+value["wl_range"][1])
+
+    return windows
+
+def get_cumulative_integrals(wl, dwl, fluxes, errors):
+    """ 
+    Cumulative sums of flux*dwl, (error*dwl)**2, wl*dwl and dwl, with a
+    leading zero, so that the integral over the pixels i0..i1 is C[i1+1]-C[i0]
+
+    `fluxes` and `errors` can be 1D (one spectrum) or 2D (n_objects x n_wl)
+    arrays, while `wl` and `dwl` are shared by all spectra
+    """
+
+    cumul = OrderedDict()
+    for key, integrand in (("flux", fluxes*dwl), ("variance", (errors*dwl)**2), 
+            ("wl", wl*dwl), ("dwl", dwl)):
+        zero = np.zeros(np.shape(integrand)[:-1] + (1,))
+        cumul[key] = np.concatenate((zero, np.cumsum(integrand, axis=-1, dtype=np.float64)), axis=-1)
+
+    return cumul
+
+def integrate_window(cumul, i0, i1):
+    """ 
+    Integral over the pixels i0..i1 from the cumulative integral `cumul`. For
+    a 2D `cumul` (one row per object), `i0` and `i1` have one row per object
+    """
 
-    wl = hdulist[1].data['wavelength'] * 1.E+10
-    minw = hdulist[1].data['minw'] * 1.E+10
-    maxw = hdulist[1].data['maxw'] * 1.E+10
+    # Empty (or not valid) windows integrate to zero
+    n = cumul.shape[-1] - 1
+    ok = (i0 >= 0) & (i1 >= i0)
+
+    i0 = np.clip(i0, 0, n)
+    i1 = np.clip(i1+1, 0, n)
+    if cumul.ndim == 1:
+        integral = cumul[i1] - cumul[i0]
+    else:
+        rows = np.arange(cumul.shape[0]).reshape((-1,) + (1,)*(i0.ndim-1))
+        integral = cumul[rows,i1] - cumul[rows,i0]
+
+    return np.where(ok, integral, 0.)
+
+def measure_lines(wl, minw, maxw, dwl, fluxes, errors, redshift, windows, cumul=None):
+    """ 
+    Measure all the lines of a spectrum (or of a cube of spectra sharing the
+    same wavelength grid) at once, using the cumulative integrals of the
+    spectrum, so that each line and continuum window costs a difference of
+    two elements
+
+    Parameters
+    ----------
+    wl, minw, maxw, dwl : numpy arrays
+        Central, minimum, maximum wavelength and width of each pixel (Ang)
+
+    fluxes, errors : numpy arrays
+        Flux and flux error (F_lambda), either 1D or 2D (n_objects x n_wl)
+
+    redshift : float or numpy array
+        Redshift of the spectrum, or of each object of the cube
+
+    windows : dict
+        Rest-frame windows of the lines, as returned by `get_line_windows`
+
+    cumul : dict, optional
+        Cumulative integrals, as returned by `get_cumulative_integrals`
+
+    Returns
+    -------
+    measurements : OrderedDict
+        Continuum-subtracted integrated flux ("flux", erg s^-1 cm^-2), its
+        error ("flux_err"), the continuum at the centre of the line
+        ("continuum", F_lambda), the rest-frame equivalent width ("EW", Ang)
+        and the signal-to-noise ratio ("SN") of each line, with shape
+        (n_lines,) or (n_objects, n_lines). Lines that are not measured are
+        set to -99.99.
+    """
+
+    if cumul is None:
+        cumul = get_cumulative_integrals(wl, dwl, fluxes, errors)
+
+    cube = np.ndim(fluxes) == 2
     nwl = len(wl)
-    dwl = hdulist[1].data['deltaw'] * 1.E+10
-    fluxes = hdulist[1].data['FLUX_FLAMBDA']
-    errors = hdulist[1].data['NOISE_FLAMBDA']
+    z1 = 1.+np.reshape(redshift, (-1, 1))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # Pixels covered by the lines
+        wl_range = windows["wl_range"] * z1[:,:,np.newaxis]
+        covered = (wl_range[...,0] <= wl[-1]) & (wl_range[...,1] >= wl[0])
+        i0 = np.searchsorted(wl, wl_range[...,0]) - 1
+        i1 = np.minimum(np.searchsorted(wl, wl_range[...,1]), nwl-1)
+
+        # Left continuum, either from the user-defined window, or from the
+        # pixels i0-5...i0-2
+        continuum_left = windows["continuum_left"] * z1[:,:,np.newaxis]
+        user = ~np.isnan(continuum_left[...,0])
+        il0 = np.searchsorted(wl, continuum_left[...,0]) - 1
+        il1 = np.searchsorted(wl, continuum_left[...,1])
+        il0 = np.where(il0 == il1, il0-1, il0)
+        left = np.where(user, (continuum_left[...,0] >= wl[0]) & (continuum_left[...,1] <= wl[-1]), i0 > 4)
+        il0 = np.where(user, il0, np.maximum(0, i0-5))
+        il1 = np.where(user, il1, il0+3)
+
+        # The continuum windows cannot overlap with the line
+        shift = np.maximum(0, il1-i0+1)
+        il0 -= shift
+        il1 -= shift
+        left &= (il0 >= 0)
+
+        # Right continuum, either from the user-defined window, or from the
+        # pixels i1+2...i1+5
+        continuum_right = windows["continuum_right"] * z1[:,:,np.newaxis]
+        user = ~np.isnan(continuum_right[...,0])
+        ir0 = np.searchsorted(wl, continuum_right[...,0]) - 1
+        ir1 = np.searchsorted(wl, continuum_right[...,1])
+        ir0 = np.where(ir0 == ir1, ir0-1, ir0)
+        right = np.where(user, (continuum_right[...,0] >= wl[0]) & (continuum_right[...,1] <= wl[-1]), nwl-i1 > 4)
+        ir1 = np.where(user, ir1, np.minimum(nwl-1, i1+5))
+        ir0 = np.where(user, ir0, ir1-3)
+
+        shift = np.maximum(0, i1-ir0+1)
+        ir0 += shift
+        ir1 += shift
+        right &= (ir0 >= 0) & (ir1 <= nwl-1)
+
+        il0, il1 = np.clip(il0, 0, nwl-1), np.clip(il1, 0, nwl-1)
+        ir0, ir1 = np.clip(ir0, 0, nwl-1), np.clip(ir1, 0, nwl-1)
+
+        # The integrals of the flux and variance are different for each
+        # object, while those of wl and dwl are shared by all objects
+        if not cube:
+            cumul = OrderedDict((key, np.atleast_2d(value)) if key in ("flux", "variance") 
+                    else (key, value) for key, value in cumul.iteritems())
+
+        # Average continuum on the left and right of the line
+        dwl_left = maxw[il1] - minw[il0]
+        flux_left = integrate_window(cumul["flux"], il0, il1) / dwl_left
+        wl_left = 0.5*(maxw[il1] + minw[il0])
+
+        dwl_right = maxw[ir1] - minw[ir0]
+        flux_right = integrate_window(cumul["flux"], ir0, ir1) / dwl_right
+        wl_right = 0.5*(maxw[ir1] + minw[ir0])
+
+        # Approximate the continuum with a straight line (a constant if only
+        # one side is available)
+        both = left & right
+        grad = np.where(both, (flux_right-flux_left)/(wl_right-wl_left), 0.)
+        intercept = np.where(both, flux_right - grad*wl_right, 
+                np.where(left, flux_left, np.where(right, flux_right, 0.)))
+
+        # Integral of the continuum-subtracted flux
+        integrated_flux = integrate_window(cumul["flux"], i0, i1) \
+                - grad*integrate_window(cumul["wl"], i0, i1) \
+                - intercept*integrate_window(cumul["dwl"], i0, i1)
+        integrated_flux_error = np.sqrt(integrate_window(cumul["variance"], i0, i1))
+
+        # Continuum at the centre of the line, and rest-frame EW
+        continuum = grad*windows["wl_central"]*z1 + intercept
+        EW = integrated_flux / continuum / z1
+
+        covered &= (i0 >= 0)
+        measured = covered & (integrated_flux > 0.)
+
+        measurements = OrderedDict()
+        measurements["flux"] = np.where(covered, integrated_flux, -99.99)
+        measurements["flux_err"] = np.where(covered, integrated_flux_error, -99.99)
+        measurements["continuum"] = np.where(covered, continuum, -99.99)
+        measurements["EW"] = np.where(covered & (continuum > 0.), EW, -99.99)
+        measurements["SN"] = np.where(measured, integrated_flux/integrated_flux_error, -99.99)
+
+    if not cube:
+        for key, value in measurements.iteritems():
+            measurements[key] = value[0,:]
+
+    return measurements
+
+def read_spectrum(file_name):
+
+    hdulist = fits.open(file_name)
+
+    spectrum = OrderedDict()
+    spectrum["redshift"] = hdulist[1].header['redshift']
+    spectrum["wl"] = hdulist[1].data['wavelength'] * 1.E+10
+    spectrum["minw"] = hdulist[1].data['minw'] * 1.E+10
+    spectrum["maxw"] = hdulist[1].data['maxw'] * 1.E+10
+    spectrum["dwl"] = hdulist[1].data['deltaw'] * 1.E+10
+    spectrum["fluxes"] = np.array(hdulist[1].data['FLUX_FLAMBDA'])
+    spectrum["errors"] = np.array(hdulist[1].data['NOISE_FLAMBDA'])
+
+    # Noiseless spectrum, converted from Jy to F_lambda as FLUX_FLAMBDA
+    spectrum["noiseless"] = hdulist[1].data['RSPEC'] * 1.E-23 * c_light / spectrum["wl"]**2
+
+    hdulist.close()
+
+    return spectrum
+
+def read_spectra_cube(file_names):
+    """ 
+    Read several simulated spectra sharing the same wavelength grid (e.g. all
+    the outputs of one filter/grating configuration) into a cube
+
+    Returns
+    -------
+    cube : OrderedDict
+        Same keys as `read_spectrum`, with "fluxes", "errors" and
+        "noiseless" of shape (n_objects, n_wl) and "redshift" of shape
+        (n_objects,)
+    """
+
+    cube = None
+    for i, file_name in enumerate(file_names):
+        spectrum = read_spectrum(file_name)
+
+        if cube is None:
+            cube = OrderedDict()
+            for key in ("wl", "minw", "maxw", "dwl"):
+                cube[key] = spectrum[key]
+            for key in ("fluxes", "errors", "noiseless"):
+                cube[key] = np.zeros((len(file_names), len(spectrum["wl"])))
+            cube["redshift"] = np.zeros(len(file_names))
+        elif not np.array_equal(spectrum["wl"], cube["wl"]):
+            raise ValueError("The spectrum `" + file_name + "` has a different wavelength grid from `" 
+                    + file_names[0] + "`")
+
+        for key in ("fluxes", "errors", "noiseless"):
+            cube[key][i,:] = spectrum[key]
+        cube["redshift"][i] = spectrum["redshift"]
+
+    return cube
+
+def measure_lines_MC(wl, minw, maxw, dwl, noiseless, errors, redshift, windows, 
+        n_draws=100, threshold=3., deviates=None, random_state=None, measure=None):
+    """ 
+    Distribution of the S/N of the lines, measured on `n_draws` noise
+    realizations of the noiseless spectrum (or cube of spectra) `noiseless`,
+    drawn at once from the noise `errors`. The standard normal deviates can
+    be passed through `deviates`, with shape (n_objects, n_draws, n_wl).
+    The lines are measured with `measure_lines`, or with the function
+    `measure` taking the same arguments (e.g. `fit_lines`).
+
+    Returns
+    -------
+    distributions : OrderedDict
+        Percentiles (`MC_percentiles`) of the S/N ("SN_p16", ...) and
+        probability of detecting the line with S/N >= `threshold` ("P_det"),
+        with shape (n_lines,) or (n_objects, n_lines). Lines that are not
+        measured are set to -99.99.
+    """
+
+    if random_state is None:
+        random_state = np.random
+
+    if measure is None:
+        measure = measure_lines
+
+    cube = np.ndim(noiseless) == 2
+    noiseless = np.atleast_2d(noiseless)
+    errors = np.atleast_2d(errors)
+    n_objects, n_wl = noiseless.shape
+
+    if deviates is None:
+        deviates = random_state.normal(0.0, 1.0, (n_objects, n_draws, n_wl))
+
+    # Block of (n_objects x n_draws) noisy spectra
+    fluxes = np.repeat(noiseless, n_draws, axis=0)
+    fluxes += np.repeat(errors, n_draws, axis=0) * np.reshape(deviates, fluxes.shape)
+    redshifts = np.repeat(np.broadcast_to(redshift, (n_objects,)), n_draws)
+
+    measurements = measure(wl, minw, maxw, dwl, fluxes, np.repeat(errors, n_draws, axis=0), 
+            redshifts, windows)
+
+    shape = (n_objects, n_draws, -1)
+    covered = np.reshape(measurements["flux_err"] >= 0., shape)[:,0,:]
+    SN = np.reshape(measurements["flux"] / measurements["flux_err"], shape)
+
+    distributions = OrderedDict()
+    with np.errstate(invalid='ignore'):
+        for p, value in zip(MC_percentiles, np.percentile(SN, MC_percentiles, axis=1)):
+            distributions["SN_p" + "{:g}".format(p)] = np.where(covered, value, -99.99)
+        distributions["P_det"] = np.where(covered, np.mean(SN >= threshold, axis=1), -99.99)
+
+    if not cube:
+        for key, value in distributions.iteritems():
+            distributions[key] = value[0,:]
+
+    return distributions
+
+def get_lines_SN(file_name, lines, expected=False):
+
+    spectrum = read_spectrum(file_name)
+
+    # The expected S/N is measured on the noiseless spectrum (RSPEC), with
+    # the same noise (NOISE) and continuum subtraction
+    if expected:
+        fluxes = spectrum["noiseless"]
+    else:
+        fluxes = spectrum["fluxes"]
+
+    measurements = measure_lines(spectrum["wl"], spectrum["minw"], spectrum["maxw"], 
+            spectrum["dwl"], fluxes, spectrum["errors"], spectrum["redshift"], 
+            get_line_windows(lines))
 
     SN = OrderedDict()
-    for key, value in lines.iteritems():
-        SN[key] = -99.99
-
-    # Cycle across all the lines for which we compute the EWs
-    for key, value in lines.iteritems():
-
-        #print "key: ", key
-
-        #### 
-        wl_range = np.array(value["wl_range"]) * (1.+redshift)
-        if wl_range[0] > wl[-1] or wl_range[1] < wl[0]:
-            continue
-        i0 = np.searchsorted(wl, wl_range[0]) ; i0 -= 1
-        i1 = np.searchsorted(wl, wl_range[1])
-        n_wl = i1-i0+1
-
-        # Compute the average left continuum
-        il0, flux_left = None, None
-        if 'continuum_left' in value:
-            continuum_left = np.array(value["continuum_left"]) * (1.+redshift)
-            if continuum_left[0] >= wl[0] and continuum_left[1] <= wl[-1]:
-                il0 = np.searchsorted(wl, continuum_left[0]) ; il0 -= 1
-                il1 = np.searchsorted(wl, continuum_left[1])
-                if il0 == il1:
-                    il0 -= 1
-        else:
-            if i0 > 4:
-                il0 = max(0, i0-5)
-                il1 = il0 + 3
-
-        if il0 is not None:
-            while il1 >= i0:
-                il1 -= 1
-                il0 -= 1
-
-        if il0 is not None:
-            dwl_left = maxw[il1] - minw[il0]
-            flux_left = np.sum(fluxes[il0:il1+1]*dwl[il0:il1+1]) / dwl_left
-            err_flux_left = np.sqrt(np.sum((errors[il0:il1+1]*dwl[il0:il1+1])**2)) / dwl_left
-            wl_left = 0.5*(maxw[il1] + minw[il0])
-            #print "wl left, dwl: ", wl[il0:il1+1], dwl[il0:il1+1]
-            #print "flux_left: ", wl_left, flux_left, flux_left/err_flux_left
-
-        # Compute the average right continuum
-        ir0, flux_right = None, None
-        if 'continuum_right' in value:
-            continuum_right = np.array(value["continuum_right"]) * (1.+redshift)
-            if continuum_right[0] >= wl[0] and continuum_right[1] <= wl[-1]:
-                ir0 = np.searchsorted(wl, continuum_right[0]) ; ir0 -= 1
-                ir1 = np.searchsorted(wl, continuum_right[1])
-                if ir0 == ir1:
-                    ir0 -= 1
+    for key, value in zip(lines, measurements["SN"]):
+        SN[key] = value
+
+    return SN
+
+def get_lines_SN_cube(wl, minw, maxw, dwl, fluxes, errors, redshifts, lines):
+    """ 
+    S/N of the lines in the JSON configuration `lines` for a cube of spectra
+    with shape (n_objects, n_wl) sharing the wavelength grid `wl`, and
+    redshifts `redshifts`
+
+    Returns
+    -------
+    SN : numpy array
+        2D array of shape (n_objects, n_lines)
+    """
+
+    measurements = measure_lines(wl, minw, maxw, dwl, fluxes, errors, redshifts, 
+            get_line_windows(lines))
+
+    return measurements["SN"]
+
+def get_line_quantities(options=None):
+
+    quantities = list(line_quantities)
+    if options is not None and options["MC_draws"] > 0:
+        quantities += ["SN_p" + "{:g}".format(p) for p in MC_percentiles] + ["P_det"]
+
+    return quantities
+
+def get_random_seed(file_name, seed):
+
+    # The seed depends on the spectrum, so that its noise realizations do not
+    # depend on how the spectra are grouped into chunks
+    return (seed + zlib.crc32(os.path.basename(file_name))) & 0xffffffff
+
+def get_options_hash(options, configurations=None):
+    """ 
+    Hash (CRC32) of all the measurement options, i.e. the mode, the Monte
+    Carlo draws, S/N threshold and seed, the components, resolution curve
+    and redshift step of the fit, and the content of the line
+    configurations (windows of each line), used to check that a previous
+    table was measured with the same options
+    """
+
+    if options is None:
+        options = default_options
+
+    values = [options["expected"], options["MC_draws"], options["SN_threshold"], options["seed"]]
+
+    fit = options["fit"]
+    if fit is not None:
+        resolution = None
+        if fit["resolution"] is not None:
+            resolution = [zlib.crc32(np.ascontiguousarray(a, dtype=np.float64).tostring()) 
+                    for a in fit["resolution"]]
+        values += [fit["components"], resolution, fit["redshift_step"]]
+
+    if configurations is not None:
+        for name, lines in configurations.iteritems():
+            values.append([name, zlib.crc32(json.dumps(lines)) & 0xffffffff])
+
+    return zlib.crc32(json.dumps(values, sort_keys=True)) & 0xffffffff
+
+def measure_spectra(spectra, configurations, options=None, seeds=None):
+    """ 
+    Measure the lines of several JSON configurations (an OrderedDict of
+    configuration name -> lines) for a cube of spectra read by
+    `read_spectra_cube`, computing the cumulative integrals once. If
+    options["expected"] is True, the lines are measured on the noiseless
+    spectra, giving the expected (deterministic) fluxes and S/N. If
+    options["fit"] is set, the lines are fitted with `fit_lines` instead of
+    being integrated over their windows.
+
+    Returns
+    -------
+    measurements : list
+        For each spectrum, a list with one OrderedDict per configuration,
+        with the quantities returned by `measure_lines` (and by
+        `measure_lines_MC` if options["MC_draws"] > 0) for each line
+    """
+
+    if options is None:
+        options = default_options
+
+    if options["expected"]:
+        fluxes = spectra["noiseless"]
+    else:
+        fluxes = spectra["fluxes"]
+
+    cumul = get_cumulative_integrals(spectra["wl"], spectra["dwl"], fluxes, spectra["errors"])
+
+    deviates = None
+    if options["MC_draws"] > 0:
+        if seeds is None:
+            seeds = (options["seed"],) * len(spectra["redshift"])
+        shape = (options["MC_draws"], len(spectra["wl"]))
+        deviates = np.array([np.random.RandomState(seed).normal(0.0, 1.0, shape) for seed in seeds])
+
+    measurements = [list() for z in spectra["redshift"]]
+    for lines in configurations.itervalues():
+        windows = get_line_windows(lines)
+        if options["fit"] is None:
+            measure = partial(measure_lines, cumul=cumul)
         else:
-            if nwl-i1 > 4:
-                ir1 = min(nwl-1, i1+5)
-                ir0 = ir1 - 3
-
-        if ir0 is not None:
-            while ir0 <= i1:
-                ir1 += 1
-                ir0 += 1
-
-        if ir0 is not None:
-            dwl_right = maxw[ir1] - minw[ir0]
-            flux_right = np.sum(fluxes[ir0:ir1+1]*dwl[ir0:ir1+1]) / dwl_right
-            err_flux_right = np.sqrt(np.sum((errors[ir0:ir1+1]*dwl[ir0:ir1+1])**2)) / dwl_right
-            wl_right = 0.5*(maxw[ir1] + minw[ir0])
-            #print "wl right, dwl: ", wl[ir0:ir1+1], dwl[ir0:ir1+1]
-            #print "flux_right: ", wl_right, flux_right, flux_right/err_flux_right
-
-        # Approximate the continuum with a straght line
-        if flux_left is not None and flux_right is not None:
-            grad = (flux_right-flux_left)/(wl_right-wl_left)
-            grad_error = np.sqrt(err_flux_left**2 + err_flux_right**2) / (wl_right-wl_left)
+            measure = partial(fit_lines, 
+                    templates=get_line_templates(lines, windows["wl_central"], options["fit"]["components"]),
+                    resolution=options["fit"]["resolution"], redshift_step=options["fit"]["redshift_step"])
+
+        m = measure(spectra["wl"], spectra["minw"], spectra["maxw"], 
+                spectra["dwl"], fluxes, spectra["errors"], spectra["redshift"], windows)
+
+        if deviates is not None:
+            m.update(measure_lines_MC(spectra["wl"], spectra["minw"], spectra["maxw"], 
+                spectra["dwl"], spectra["noiseless"], spectra["errors"], spectra["redshift"], 
+                windows, n_draws=options["MC_draws"], threshold=options["SN_threshold"], 
+                deviates=deviates, measure=None if options["fit"] is None else measure))
+
+        for j in range(len(measurements)):
+            measurements[j].append(OrderedDict((key, value[j,:]) for key, value in m.iteritems()))
+
+    return measurements
+
+def measure_lines_file(file_name, configurations, options=None):
+    """ 
+    Measure the lines of several JSON configurations reading the spectrum
+    once (see `measure_spectra`)
+    """
+
+    return measure_lines_chunk([file_name], configurations, options=options)[0]
+
+def get_MC_draw(folder):
+
+    # Extract the Monte Carlo draw from the folder name
+    MC_draw = None
+    for f in folder.split('/'):
+        if 'MC_' in f:
+            MC_draw = f.split('_')[1]
+
+    return MC_draw
+
+def list_simulated_spectra(folder):
+
+    # List all simulated spectra in <folder>/ETC-output, using the index of
+    # the simulations (which is built by scanning the folder if missing)
+    index = get_simulations_index(os.path.join(folder, "ETC-output"))
+
+    file_names = index.file_names()
+    gratings = list()
+    filters = list()
+    IDs = list()
+    for f in file_names:
+        ID, MC_draw, FWA, GWA = parse_file_name(f)
+        IDs.append(ID)
+        gratings.append(GWA)
+        filters.append(FWA)
+
+    return file_names, IDs, filters, gratings
+
+def measure_lines_chunk(file_names, configurations, cube=False, options=None):
+
+    if options is None:
+        options = default_options
+
+    # In cube mode the spectra of each filter/grating configuration are
+    # measured at once, otherwise one by one
+    setups = OrderedDict()
+    for i, file_name in enumerate(file_names):
+        if cube:
+            setup = "_".join(os.path.splitext(file_name)[0].split('_')[-2:])
         else:
-            grad = 0.
-            grad_error = 0.
-        #print "grad SN: ", grad, grad/grad_error
-
-        if flux_left is not None and flux_right is not None:
-            intercept = flux_right - grad*wl_right
-            intercept_error = np.sqrt(err_flux_right**2 + (grad_error*wl_right)**2) 
-        elif flux_left is not None:
-            intercept = flux_left
-            intercept_error = err_flux_left
-        elif flux_right is not None:
-            intercept = flux_right
-            intercept_error = err_flux_right
-
-        #print "intercept SN: ", intercept, intercept/intercept_error
-
-        # Linear function approximating the continuum
-        integrand = fluxes[i0:i1+1] - (grad*wl[i0:i1+1]+intercept)
-        #print "fluxes---> ", fluxes[i0:i1+1]
-        #print "continuum-----> ", (grad*wl[i0:i1+1]+intercept)
-        integrand_errors = errors[i0:i1+1]
-        integrated_flux = np.sum(integrand*dwl[i0:i1+1])
-        integrated_flux_error = np.sqrt(np.sum((integrand_errors*dwl[i0:i1+1])**2))
-
-        if integrated_flux > 0.:
-            SN[key] = integrated_flux/integrated_flux_error
-
-        #integrand_errors = np.sqrt(errors[i0:i1+1]**2 + (grad_error*wl[i0:i1+1])**2 + intercept_error**2)
-        #integrated_flux_error = np.sqrt(np.sum((integrand_errors*dwl[i0:i1+1])**2))
-        #print "SN: ", SN[key],  integrated_flux/integrated_flux_error
-
-        #print "--------> ", wl[i0], wl[i1], integrated_flux, integrated_flux_error, SN
-    return SN
+            setup = i
+        setups.setdefault(setup, list()).append(i)
+
+    measurements = [None] * len(file_names)
+    for setup, indices in setups.iteritems():
+        _file_names = [file_names[i] for i in indices]
+        spectra = read_spectra_cube(_file_names)
+        seeds = [get_random_seed(f, options["seed"]) for f in _file_names]
+        for i, m in zip(indices, measure_spectra(spectra, configurations, options, seeds)):
+            measurements[i] = m
+
+    return measurements
+
+def get_configuration_name(json_file):
+
+    return os.path.splitext(os.path.basename(json_file))[0]
+
+def get_output_file_name(folder):
+
+    return os.path.join(folder, "Emission_lines_observational_SN_MC_" + get_MC_draw(folder) + ".fits")
+
+def merge_lines_SN(IDs, setups, fluxes, flux_errors, SN):
+    """ 
+    Merge the measurements of each object observed with several
+    filter/grating configurations, giving for each line the best S/N, the
+    configuration providing it, and the S/N of the inverse-variance weighted
+    combination of the fluxes of all the configurations covering the line
+
+    Parameters
+    ----------
+    IDs, setups : array_like
+        ID of the object and filter/grating configuration of each row
+
+    fluxes, flux_errors, SN : numpy arrays
+        Measurements with shape (n_rows, n_lines), with -99.99 where a line
+        is not measured
+
+    Returns
+    -------
+    merged : OrderedDict
+        "ID" of each object (in order of first appearance), and "SN_best",
+        "setup_best" and "SN_combined" with shape (n_objects, n_lines)
+    """
+
+    IDs = np.asarray(IDs)
+    setups = np.asarray(setups)
+    n_rows = len(IDs)
+
+    # Group the rows by object, keeping the order of first appearance
+    unique_IDs, first, groups = np.unique(IDs, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first, kind='mergesort')] = np.arange(len(first))
+    groups = rank[groups]
+
+    order = np.argsort(groups, kind='mergesort')
+    starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) > 0])
+
+    SN = np.asarray(SN)[order,:]
+    fluxes = np.asarray(fluxes)[order,:]
+    flux_errors = np.asarray(flux_errors)[order,:]
+
+    # Best S/N, and first row reaching it
+    SN_best = np.maximum.reduceat(SN, starts, axis=0)
+    row = np.arange(n_rows)[:,np.newaxis]
+    is_best = (SN == SN_best[groups[order],:]) & (SN > -99.)
+    best_row = np.minimum.reduceat(np.where(is_best, row, n_rows), starts, axis=0)
+    found = best_row < n_rows
+
+    setup_best = np.where(found, setups[order][np.minimum(best_row, n_rows-1)], "")
+
+    # Inverse-variance weighted combination of the fluxes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(flux_errors > 0., 1./flux_errors**2, 0.)
+        sum_weights = np.add.reduceat(weights, starts, axis=0)
+        SN_combined = np.add.reduceat(weights*fluxes, starts, axis=0) / np.sqrt(sum_weights)
+        SN_combined = np.where((sum_weights > 0.) & (SN_combined > 0.), SN_combined, -99.99)
+
+    merged = OrderedDict()
+    merged["ID"] = IDs[order][starts]
+    merged["SN_best"] = np.where(found, SN_best, -99.99)
+    merged["setup_best"] = setup_best
+    merged["SN_combined"] = SN_combined
+
+    return merged
+
+def write_lines_SN(file_name, IDs, filters, gratings, configurations, measurements, 
+        spectra_file_names=None, mtimes=None, options=None, merge=False):
+    """ 
+    Write the S/N of the lines of the first configuration in the `S_to_N`
+    extension, and all the measurements (flux, flux error, continuum, EW, S/N)
+    of each configuration in an extension named after the configuration. If
+    `merge` is True, the measurements of the different filter/grating
+    configurations of each object are merged (see `merge_lines_SN`) in the
+    extension <configuration>_MERGED.
+    """
+
+    new_hdulist = fits.HDUList(fits.PrimaryHDU())
+
+    for j, (name, lines) in enumerate(configurations.iteritems()):
+
+        cols = list()
+
+        cols.append(fits.Column(name='ID', format='20A', array=IDs))
+        cols.append(fits.Column(name='filter', format='20A', array=filters))
+        cols.append(fits.Column(name='grating', format='20A', array=gratings))
+
+        if j == 0:
+            S_to_N_cols = list(cols)
+            for k, key in enumerate(lines):
+                data = np.array([m[j]["SN"][k] for m in measurements])
+                S_to_N_cols.append(fits.Column(name=str(key), format='E', array=data))
+
+            new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(S_to_N_cols))
+            new_hdu.name = 'S_to_N'
+            new_hdulist.append(new_hdu)
+
+        for k, key in enumerate(lines):
+            for quantity in get_line_quantities(options):
+                data = np.array([m[j][quantity][k] for m in measurements])
+                cols.append(fits.Column(name=str(key) + "_" + quantity, format='E', array=data))
+
+        new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        new_hdu.name = name
+        new_hdulist.append(new_hdu)
+
+        if merge:
+            setups = [f + "_" + g for f, g in zip(filters, gratings)]
+            merged = merge_lines_SN(IDs, setups, 
+                    np.array([m[j]["flux"] for m in measurements]), 
+                    np.array([m[j]["flux_err"] for m in measurements]), 
+                    np.array([m[j]["SN"] for m in measurements]))
+
+            cols = [fits.Column(name='ID', format='20A', array=merged["ID"])]
+            for k, key in enumerate(lines):
+                cols.append(fits.Column(name=str(key) + "_SN_best", format='E', array=merged["SN_best"][:,k]))
+                cols.append(fits.Column(name=str(key) + "_setup_best", format='40A', array=merged["setup_best"][:,k]))
+                cols.append(fits.Column(name=str(key) + "_SN_combined", format='E', array=merged["SN_combined"][:,k]))
+
+            new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+            new_hdu.name = name + "_MERGED"
+            new_hdulist.append(new_hdu)
+
+    # The manifest records, row by row, the spectrum and its modification
+    # time, and is used to update the table incrementally
+    if spectra_file_names is not None:
+        cols = list()
+        cols.append(fits.Column(name='file', format='100A', 
+            array=[os.path.basename(f) for f in spectra_file_names]))
+        cols.append(fits.Column(name='mtime', format='D', array=mtimes))
+        new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        new_hdu.name = 'MANIFEST'
+        if options is not None:
+            new_hdu.header['EXPECTED'] = options["expected"]
+            new_hdu.header['METHOD'] = "box" if options["fit"] is None else "fit"
+            new_hdu.header['MC_DRAWS'] = options["MC_draws"]
+            new_hdu.header['SN_THR'] = options["SN_threshold"]
+            new_hdu.header['SEED'] = options["seed"]
+            new_hdu.header['OPT_HASH'] = get_options_hash(options, configurations)
+        new_hdulist.append(new_hdu)
+
+    new_hdulist.writeto(file_name, overwrite=True)
+
+def read_lines_SN(file_name, configurations, options=None):
+    """ 
+    Read the measurements written by `write_lines_SN`
+
+    Returns
+    -------
+    previous : dict
+        For each spectrum (file name without the path), its modification
+        time and measurements. The dictionary is empty if the file does not
+        exist, has no manifest, or contains a different set of
+        configurations, lines or quantities, or was measured in a
+        different (noisy / expected) mode, method (box integration / fit) or
+        any other measurement option (see `get_options_hash`).
+    """
+
+    previous = dict()
+    if not os.path.isfile(file_name):
+        return previous
+
+    quantities = get_line_quantities(options)
+
+    with fits.open(file_name) as hdulist:
+        if 'MANIFEST' not in hdulist:
+            return previous
+
+        if options is None:
+            options = default_options
+        method = "box" if options["fit"] is None else "fit"
+        header = hdulist['MANIFEST'].header
+        if header.get('EXPECTED', False) != options["expected"] or header.get('METHOD', "box") != method:
+            return previous
+
+        if header.get('OPT_HASH') != get_options_hash(options, configurations):
+            return previous
+
+        data = list()
+        for name, lines in configurations.iteritems():
+            if name not in hdulist:
+                return previous
+            names = [str(key) + "_" + quantity for key in lines for quantity in quantities]
+            if list(hdulist[name].data.columns.names[3:]) != names:
+                return previous
+            data.append(hdulist[name].data)
+
+        manifest = hdulist['MANIFEST'].data
+        for i, (f, mtime) in enumerate(zip(manifest['file'], manifest['mtime'])):
+            measurements = list()
+            for d, lines in zip(data, configurations.itervalues()):
+                m = OrderedDict()
+                for quantity in quantities:
+                    m[quantity] = np.array([d[str(key) + "_" + quantity][i] for key in lines])
+                measurements.append(m)
+            previous[f] = (mtime, measurements)
+
+    return previous
 
 if __name__ == '__main__':
 
@@ -240,78 +850,197 @@ if __name__ == '__main__':
 
     parser.add_argument(
         '--folder',
-        help="Parent folder containing the NIRSpec simulations",
-        dest="folder", 
+        help="Parent folder(s) containing the NIRSpec simulations",
+        dest="folders", 
         type=str,
+        nargs='+',
         required=True
     )
 
     parser.add_argument(
         '--json-file',
-        help="JSON file containing the list of lines (with relative wl) for which the S/N computation is required",
-        dest="json_file", 
+        help="JSON file(s) containing the list of lines (with relative wl) for which the S/N computation is required. \
+                If multiple files are passed, the lines of all of them are measured in a single pass over the spectra.",
+        dest="json_files", 
         type=str,
+        nargs='+',
         required=True
     )
 
+    parser.add_argument(
+        '--nproc',
+        help="Number of processors to use",
+        action="store", 
+        type=int, 
+        dest="nproc",
+        default=-1
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        help="Number of spectra processed by each parallel task",
+        action="store", 
+        type=int, 
+        dest="chunk_size",
+        default=50
+    )
+
+    parser.add_argument(
+        '--cube',
+        help="Measure at once all the spectra of a chunk sharing the same filter/grating configuration",
+        action="store_true", 
+        dest="cube"
+    )
+
+    parser.add_argument(
+        '--incremental',
+        help="Keep the existing S/N table, and only measure new or modified spectra",
+        action="store_true", 
+        dest="incremental"
+    )
+
+    parser.add_argument(
+        '--merge',
+        help="Merge the measurements of the different filter/grating configurations of each object, \
+                reporting the best S/N of each line, the configuration providing it, and the inverse-variance \
+                combined S/N",
+        action="store_true", 
+        dest="merge"
+    )
+
+    parser.add_argument(
+        '--expected',
+        help="Measure the expected (noise-free) S/N of the lines, integrating the noiseless spectrum (RSPEC) \
+                with the noise (NOISE) of the simulation",
+        action="store_true", 
+        dest="expected"
+    )
+
+    parser.add_argument(
+        '--MC-noise',
+        help="Number of noise realizations of the noiseless spectrum (RSPEC) used to compute \
+                percentiles of the S/N and detection probabilities of the lines",
+        action="store", 
+        type=int, 
+        dest="MC_draws",
+        default=0
+    )
+
+    parser.add_argument(
+        '--SN-threshold',
+        help="S/N threshold used to compute the detection probabilities",
+        action="store", 
+        type=float, 
+        dest="SN_threshold",
+        default=3.
+    )
+
+    parser.add_argument(
+        '--seed', 
+        help="Seed of the random number generator.",
+        action="store", 
+        type=int,
+        dest="seed",
+        default=123456
+    )
+
+    parser.add_argument(
+        '--fit',
+        help="Measure the lines by linear least-squares fitting of Gaussian profiles, rather than \
+                by integrating them over their windows",
+        action="store_true", 
+        dest="fit"
+    )
+
+    parser.add_argument(
+        '--components-file',
+        help="JSON file containing the components (rest-frame wavelengths and flux ratios) of the lines to fit",
+        action="store", 
+        type=str, 
+        dest="components_file",
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "emission_lines_components.json")
+    )
+
+    parser.add_argument(
+        '--resolution-file',
+        help="FITS file containing the resolution curve (WAVELENGTH in micron, R) used to fit the lines. \
+                By default the width of the lines is computed from the wavelength grid of the spectra",
+        action="store", 
+        type=str, 
+        dest="resolution_file"
+    )
+
+    parser.add_argument(
+        '--redshift-step',
+        help="Width of the bins in log(1+z) sharing the same design matrix of the fit (by default \
+                a quarter of the smallest pixel size in log(wavelength) of each spectrum, i.e. \
+                a flux bias below ~0.4%%, but about one bin per object for continuous redshifts; \
+                wider bins batch more objects but bias the fluxes more, see fit_emission_lines.py)",
+        action="store", 
+        type=float, 
+        dest="redshift_step"
+    )
+
     args = parser.parse_args()    
 
-    # Extract the Monte Carlo draw from the folder name
-    for f in args.folder.split('/'):
-        if 'MC_' in f:
-            MC_draw = f.split('_')[1]
+    options = {"expected": args.expected, "MC_draws": args.MC_draws, "SN_threshold": args.SN_threshold, "seed": args.seed, 
+            "fit": None}
 
-    # List all simulated spectra in <folder>/ETC-output
-    folder = os.path.join(args.folder, "ETC-output")
+    if args.fit:
+        resolution = None
+        if args.resolution_file is not None:
+            resolution = read_resolution_curve(args.resolution_file)
+        options["fit"] = {"components": read_line_components(args.components_file), 
+                "resolution": resolution, "redshift_step": args.redshift_step}
+
+    configurations = OrderedDict()
+    for json_file in args.json_files:
+        with open(json_file) as f:
+            configurations[get_configuration_name(json_file)] = json.load(f, object_pairs_hook=OrderedDict)
+
+    # List the simulated spectra of all folders, so that the parallel tasks
+    # can span several folders
+    simulations = OrderedDict()
     file_names = list()
-    gratings = list()
-    filters = list()
-    IDs = list()
-    for f in natsorted(os.listdir(folder)):
-        if f.endswith(".fits"):
-            file_names.append(f)
-            s = os.path.splitext(f)[0].split('_')
-            IDs.append(s[0])
-            gratings.append(s[-1])
-            filters.append(s[-2])
-
-    
-    cols = list()
-
-    cols.append(fits.Column(name='ID', format='20A', array=IDs))
-    cols.append(fits.Column(name='filter', format='20A', array=filters))
-    cols.append(fits.Column(name='grating', format='20A', array=gratings))
-
-    N = len(file_names)
-
-    with open(args.json_file) as f:
-        lines = json.load(f, object_pairs_hook=OrderedDict)
-
-    data = dict()
-    line_wl = list()
-    for key, value in lines.iteritems():
-        data[key] = np.zeros(N)
-        #data[key+"_1pixel"] = np.zeros(N)
-    
-    for i, f in enumerate(file_names):
-
-        file_name = os.path.join(args.folder, "ETC-output", f)
-        SN = get_lines_SN(file_name, lines)
-        for j, (key, value) in enumerate(lines.iteritems()):
-            data[key][i] = SN[key]
-            #data[key+"_1pixel"][i] = SN_1pixel[j]
-
-    for key, value in lines.iteritems():
-        cols.append(fits.Column(name=str(key), format='E', array=data[key]))
-        #cols.append(fits.Column(name=str(key+"_1pixel"), format='E', array=data[key+"_1pixel"]))
-
-    columns = fits.ColDefs(cols)
-    new_hdu = fits.BinTableHDU.from_columns(columns)
-    new_hdu.name = 'S_to_N'
+    for folder in args.folders:
+        _file_names, IDs, filters, gratings = list_simulated_spectra(folder)
+        mtimes = [os.path.getmtime(f) for f in _file_names]
 
-    new_hdulist = fits.HDUList(fits.PrimaryHDU())
-    new_hdulist.append(new_hdu)
+        # In incremental mode the measurements of spectra that have not been
+        # modified since the last run are taken from the existing table
+        previous = dict()
+        if args.incremental:
+            previous = read_lines_SN(get_output_file_name(folder), configurations, options)
+
+        measurements = list()
+        for file_name, mtime in zip(_file_names, mtimes):
+            p = previous.get(os.path.basename(file_name))
+            if p is not None and p[0] == mtime:
+                measurements.append(p[1])
+            else:
+                measurements.append(None)
+                file_names.append(file_name)
 
+        simulations[folder] = (_file_names, IDs, filters, gratings, mtimes, measurements)
 
-    file_name = os.path.join(args.folder, "Emission_lines_observational_SN_MC_" + MC_draw + ".fits")
-    new_hdulist.writeto(file_name, overwrite=True)
+    chunks = [file_names[i:i+args.chunk_size] for i in range(0, len(file_names), args.chunk_size)]
+
+    if args.nproc <= 0:
+        results = [measure_lines_chunk(chunk, configurations, args.cube, options) for chunk in chunks]
+    else:
+        # Set number of parellel processes to use
+        pool = ProcessingPool(nodes=args.nproc)
+
+        # The map preserves the order of the chunks, hence the results are
+        # assembled in the same (deterministic) order as the input files
+        results = pool.map(measure_lines_chunk, chunks, (configurations,)*len(chunks), 
+                (args.cube,)*len(chunks), (options,)*len(chunks))
+
+    measured = dict(zip(file_names, [m for result in results for m in result]))
+
+    for folder, (_file_names, IDs, filters, gratings, mtimes, measurements) in simulations.iteritems():
+        measurements = [measured[f] if m is None else m for f, m in zip(_file_names, measurements)]
+        print "Folder ", folder, ": ", sum(f in measured for f in _file_names), " spectra measured, ", \
+                len(_file_names), " in total"
+        write_lines_SN(get_output_file_name(folder), IDs, filters, gratings, configurations, measurements, 
+                spectra_file_names=_file_names, mtimes=mtimes, options=options, merge=args.merge)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import argparse
+import os
+import json
+import numpy as np
+from astropy.io import fits
+from scipy.special import ndtr
+from scipy.interpolate import RegularGridInterpolator
+
+from compute_emission_line_SN import get_line_windows, measure_lines, read_spectra_cube
+from fit_emission_lines import get_line_profiles
+from simulations_index import get_simulations_index
+
+def get_noise_curves(folder, max_spectra=None):
+    """
+    Noise curves of the simulated spectra contained in the ETC-output
+    `folder`, for each (filter, grating, number of exposures) configuration
+
+    Parameters
+    ----------
+    folder : str
+        ETC-output folder
+
+    max_spectra : int, optional
+        Maximum number of spectra read for each configuration
+
+    Returns
+    -------
+    curves : OrderedDict
+        (FWA, GWA, nexp) -> OrderedDict with the wavelength grid ("wl",
+        "minw", "maxw", "dwl", Ang) and the median noise of the spectra
+        ("errors", F_lambda)
+    """
+
+    index = get_simulations_index(folder)
+
+    setups = OrderedDict()
+    for (ID, MC_draw, FWA, GWA, nexp), name in index.entries.iteritems():
+        setups.setdefault((FWA, GWA, nexp), list()).append(os.path.join(folder, name))
+
+    curves = OrderedDict()
+    for setup, file_names in setups.iteritems():
+        cube = read_spectra_cube(file_names[:max_spectra])
+
+        curve = OrderedDict()
+        for key in ("wl", "minw", "maxw", "dwl"):
+            curve[key] = cube[key]
+        curve["errors"] = np.median(cube["errors"], axis=0)
+
+        curves[setup] = curve
+
+    return curves
+
+def get_expected_flux_terms(curve, lines, redshifts, beta=-2.):
+    """
+    Expected measurements of the lines in the JSON configuration `lines` at
+    each redshift, for a given noise curve
+
+    Since the measurements are linear in the spectrum, the flux measured for
+    a line of flux F and rest-frame equivalent width EW at redshift z is
+    F * (line + continuum / (EW * (1+z))), where "line" is the flux measured
+    for a line of unit flux, and "continuum" the one measured for a
+    continuum F_lambda ~ lambda^beta of unit value at the line centre (i.e.
+    the residual of the continuum subtraction). The flux error only depends
+    on the noise curve.
+
+    Returns
+    -------
+    terms : OrderedDict
+        "line", "continuum" and "flux_err", arrays of shape (n_redshifts,
+        n_lines), with flux_err < 0 when the line is not covered
+    """
+
+    windows = get_line_windows(lines)
+
+    n_z, n_lines = len(redshifts), len(lines)
+
+    # One spectrum for each (redshift, line), containing only that line
+    z = np.repeat(redshifts, n_lines)
+    wl_lines = np.outer(1.+np.asarray(redshifts), windows["wl_central"]).ravel()
+
+    profiles = get_line_profiles(curve["wl"], curve["minw"], curve["maxw"], curve["dwl"], wl_lines)
+    continua = (curve["wl"] / wl_lines[:,np.newaxis])**beta
+    errors = np.broadcast_to(curve["errors"], profiles.shape)
+
+    # Each spectrum is measured only in the windows of its own line
+    rows = np.arange(n_z*n_lines)
+    columns = np.tile(np.arange(n_lines), n_z)
+
+    terms = OrderedDict()
+    m = measure_lines(curve["wl"], curve["minw"], curve["maxw"], curve["dwl"],
+            profiles, errors, z, windows)
+    terms["line"] = np.reshape(m["flux"][rows,columns], (n_z, n_lines))
+    terms["flux_err"] = np.reshape(m["flux_err"][rows,columns], (n_z, n_lines))
+
+    m = measure_lines(curve["wl"], curve["minw"], curve["maxw"], curve["dwl"],
+            continua, errors, z, windows)
+    terms["continuum"] = np.reshape(m["flux"][rows,columns], (n_z, n_lines))
+
+    return terms
+
+def compute_completeness(terms, redshifts, line_fluxes, EWs, threshold=3.):
+    """
+    Expected S/N and detection fraction on the grid (redshift, line flux,
+    rest-frame EW) for each line
+
+    Given the Gaussian noise, the measured S/N follows a normal distribution
+    of unit width centred on the expected S/N, hence the detection fraction
+    at a S/N `threshold` is Phi(S/N - threshold)
+
+    Returns
+    -------
+    SN, completeness : numpy arrays
+        4D arrays of shape (n_redshifts, n_line_fluxes, n_EWs, n_lines), with
+        S/N = -99.99 and completeness = 0 where the line is not covered
+    """
+
+    z1 = 1.+np.reshape(redshifts, (-1, 1, 1))
+    EWs = np.reshape(EWs, (1, -1, 1))
+
+    line = terms["line"][:,np.newaxis,:]
+    continuum = terms["continuum"][:,np.newaxis,:]
+    flux_err = terms["flux_err"][:,np.newaxis,np.newaxis,:]
+    covered = np.broadcast_to(flux_err >= 0.,
+            (len(redshifts), len(line_fluxes), EWs.size, line.shape[-1]))
+
+    # Measured flux per unit line flux, shape (n_redshifts, n_EWs, n_lines)
+    factor = line + continuum / (EWs*z1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SN = np.reshape(line_fluxes, (1, -1, 1, 1)) * factor[:,np.newaxis,:,:] / flux_err
+
+    completeness = np.where(covered, ndtr(SN-threshold), 0.)
+    SN = np.where(covered, SN, -99.99)
+
+    return SN, completeness
+
+def get_grid(grid):
+
+    _min, _max, step = grid
+
+    return np.linspace(_min, _max, int(round((_max-_min)/step))+1)
+
+def get_completeness_file_name(folder, FWA, GWA, nexp):
+
+    name = "Line_completeness_" + FWA + "_" + GWA
+    if nexp is not None:
+        name += "_nexp_" + str(nexp)
+
+    return os.path.join(folder, name + ".fits")
+
+def write_completeness(file_name, lines, redshifts, log_line_fluxes, log_EWs, SN, completeness,
+        header=None):
+    """
+    Write the completeness tables, one image extension (redshift, log10 line
+    flux, log10 EW) per line, plus the expected S/N and the grid axes
+    """
+
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
+    if header is not None:
+        for key, value in header.iteritems():
+            hdulist[0].header[key] = value
+
+    for name, axis in zip(("REDSHIFT", "LOG_FLUX", "LOG_EW"), (redshifts, log_line_fluxes, log_EWs)):
+        hdulist.append(fits.ImageHDU(np.asarray(axis, dtype=np.float64), name=name))
+
+    for k, key in enumerate(lines):
+        # FITS images are stored with the axes in reverse order, hence the
+        # first numpy axis is the redshift
+        hdulist.append(fits.ImageHDU(np.float32(completeness[...,k]), name=str(key)))
+        hdulist.append(fits.ImageHDU(np.float32(SN[...,k]), name=str(key) + "_SN"))
+
+    hdulist.writeto(file_name, overwrite=True)
+
+def read_completeness(file_name, line, quantity=None):
+    """
+    Interpolator of the completeness of `line` (or of its expected S/N if
+    quantity="SN") as a function of (redshift, log10 line flux [erg s^-1
+    cm^-2], log10 rest-frame EW [Ang]), returning NaN outside the grid
+    """
+
+    name = line
+    if quantity is not None:
+        name += "_" + quantity
+
+    with fits.open(file_name) as hdulist:
+        axes = [np.array(hdulist[key].data) for key in ("REDSHIFT", "LOG_FLUX", "LOG_EW")]
+        data = np.array(hdulist[name].data, dtype=np.float64)
+
+    return RegularGridInterpolator(axes, data, bounds_error=False, fill_value=np.nan)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--folder',
+        help="ETC-output folder(s) containing the simulated NIRSpec spectra used for the noise curves",
+        action="store",
+        type=str,
+        nargs='+',
+        dest="folders",
+        required=True
+    )
+
+    parser.add_argument(
+        '--json-file',
+        help="JSON file containing the emission lines configuration",
+        action="store",
+        type=str,
+        dest="json_file",
+        required=True
+    )
+
+    parser.add_argument(
+        '--redshift-grid',
+        help="Minimum, maximum and step of the redshift grid",
+        action="store",
+        type=float,
+        nargs=3,
+        dest="redshift_grid",
+        default=[0.5, 10., 0.05]
+    )
+
+    parser.add_argument(
+        '--flux-grid',
+        help="Minimum, maximum and step of the grid of log10 line fluxes (erg s^-1 cm^-2)",
+        action="store",
+        type=float,
+        nargs=3,
+        dest="flux_grid",
+        default=[-19., -16., 0.05]
+    )
+
+    parser.add_argument(
+        '--EW-grid',
+        help="Minimum, maximum and step of the grid of log10 rest-frame equivalent widths (Ang)",
+        action="store",
+        type=float,
+        nargs=3,
+        dest="EW_grid",
+        default=[0., 3., 0.05]
+    )
+
+    parser.add_argument(
+        '--beta',
+        help="UV slope of the continuum, F_lambda ~ lambda^beta",
+        action="store",
+        type=float,
+        dest="beta",
+        default=-2.
+    )
+
+    parser.add_argument(
+        '--SN-threshold',
+        help="S/N threshold of the detections",
+        action="store",
+        type=float,
+        dest="SN_threshold",
+        default=3.
+    )
+
+    parser.add_argument(
+        '--max-spectra',
+        help="Maximum number of spectra used to compute the median noise curve of each configuration",
+        action="store",
+        type=int,
+        dest="max_spectra",
+        default=100
+    )
+
+    parser.add_argument(
+        '--output-folder',
+        help="Folder where the completeness tables are written (by default the ETC-output folder)",
+        action="store",
+        type=str,
+        dest="output_folder"
+    )
+
+    args = parser.parse_args()
+
+    with open(args.json_file) as f:
+        lines = json.load(f, object_pairs_hook=OrderedDict)
+
+    redshifts = get_grid(args.redshift_grid)
+    log_line_fluxes = get_grid(args.flux_grid)
+    log_EWs = get_grid(args.EW_grid)
+
+    for folder in args.folders:
+        output_folder = args.output_folder or folder
+
+        for (FWA, GWA, nexp), curve in get_noise_curves(folder, args.max_spectra).iteritems():
+            terms = get_expected_flux_terms(curve, lines, redshifts, beta=args.beta)
+
+            SN, completeness = compute_completeness(terms, redshifts, 10.**log_line_fluxes,
+                    10.**log_EWs, threshold=args.SN_threshold)
+
+            header = OrderedDict([("FWA", FWA), ("GWA", GWA), ("NEXP", nexp),
+                ("SN_THR", args.SN_threshold), ("BETA", args.beta),
+                ("CONFIG", os.path.basename(args.json_file))])
+
+            file_name = get_completeness_file_name(output_folder, FWA, GWA, nexp)
+            write_completeness(file_name, lines, redshifts, log_line_fluxes, log_EWs,
+                    SN, completeness, header=header)
+
+            print "Configuration ", FWA, GWA, nexp, ": completeness written to ", file_name
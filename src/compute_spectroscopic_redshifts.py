@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import argparse
+import os
+from astropy.io import fits
+import numpy as np
+from scipy.ndimage import median_filter, gaussian_filter1d
+
+from pathos.multiprocessing import ProcessingPool
+
+from compute_emission_line_SN import read_spectra_cube, list_simulated_spectra, get_MC_draw
+from fit_emission_lines import LSF_pixels, read_line_components
+
+# Relative fluxes of the lines of the default emission-line template,
+# typical of star-forming galaxies (the components of each line are taken
+# from emission_lines_components.json)
+default_line_strengths = OrderedDict([
+    ("OIII_1661_1661", 0.05),
+    ("CIII_1907_1909", 0.1),
+    ("OII_3727", 0.5),
+    ("Hgamma_OIII_4363_FeII_4300", 0.17),
+    ("Hbeta", 0.35),
+    ("OIII_4959_5007", 1.3),
+    ("Halpha_NII", 1.0),
+    ("SII", 0.15),
+    ("SIII_9068", 0.1),
+    ("SIII_9530", 0.1)
+    ])
+
+# Rest-frame log-wavelength grid on which the templates are defined before
+# being rebinned to the grid of the spectra
+template_wl_range = (900., 12000.)
+template_log_step = 2.E-05
+
+# Fourier transforms of the templates rebinned to the grid of the spectra,
+# computed once per template and grid
+_template_cache = dict()
+
+def get_line_template(components, strengths=None):
+    """
+    Rest-frame emission-line template, i.e. the sum of narrow Gaussian lines
+    with fluxes `strengths` (and flux ratios of their components from
+    `components`, as read by `read_line_components`)
+
+    Returns
+    -------
+    template : tuple
+        Rest-frame wavelength (Ang) and F_lambda of the template
+    """
+
+    if strengths is None:
+        strengths = default_line_strengths
+
+    log_wl = np.arange(np.log(template_wl_range[0]), np.log(template_wl_range[1]), template_log_step)
+    wl = np.exp(log_wl)
+    flux = np.zeros(len(wl))
+
+    # Lines of ~30 km/s, i.e. much narrower than the line spread function
+    sigma = 1.E-04
+    for key, strength in strengths.iteritems():
+        wls = np.array(components[key]["components"], dtype=np.float64)
+        ratios = np.array(components[key].get("ratios", np.ones(len(wls))), dtype=np.float64)
+        for wl_line, ratio in zip(wls, strength*ratios/np.sum(ratios)):
+            flux += ratio * np.exp(-0.5*((log_wl-np.log(wl_line))/sigma)**2) / (np.sqrt(2.*np.pi)*sigma*wl)
+
+    return wl, flux
+
+def read_template(file_name):
+    """
+    Read a rest-frame template from an ASCII file with two columns,
+    wavelength (Ang) and F_lambda
+    """
+
+    data = np.loadtxt(file_name)
+
+    return data[:,0], data[:,1]
+
+def get_log_grid(wl, log_step=None):
+    """
+    Grid uniform in ln(wl) covering the wavelength grid `wl`, with a step of
+    half the median pixel size by default
+    """
+
+    if log_step is None:
+        log_step = 0.5*np.median(np.diff(np.log(wl)))
+
+    x0 = np.log(wl[0])
+    n = int(np.floor((np.log(wl[-1])-x0) / log_step)) + 1
+
+    return x0, log_step, n
+
+def rebin_template(template, y0, log_step, n):
+    """
+    Average F_lambda of the template over the pixels of the log-wavelength
+    grid y0 + (0...n-1)*log_step, conserving the flux of the lines
+    """
+
+    wl, flux = template
+    log_wl = np.log(wl)
+
+    # Cumulative integral of F_lambda in ln(wl), using the trapezoidal rule
+    cumul = np.concatenate(([0.], np.cumsum(0.5*(flux[1:]+flux[:-1])*np.diff(log_wl))))
+
+    edges = y0 + (np.arange(n+1)-0.5)*log_step
+    return np.diff(np.interp(edges, log_wl, cumul, left=0., right=cumul[-1])) / log_step
+
+def get_template_FFT(name, template, y0, log_step, n, n_fft, sigma_pixels, continuum_pixels):
+    """
+    Fourier transforms of the template, and of its square, rebinned to the
+    log-wavelength grid, convolved with the line spread function and
+    continuum-subtracted. The results are cached.
+    """
+
+    key = (name, round(y0/log_step, 6), log_step, n, n_fft, sigma_pixels, continuum_pixels)
+    if key not in _template_cache:
+        t = rebin_template(template, y0, log_step, n)
+        t = gaussian_filter1d(t, sigma_pixels)
+        t -= median_filter(t, size=continuum_pixels, mode='nearest')
+        _template_cache[key] = (np.fft.rfft(t, n_fft), np.fft.rfft(t**2, n_fft))
+
+    return _template_cache[key]
+
+def measure_redshifts(wl, dwl, fluxes, errors, template, name="template", redshift_range=(0., 12.),
+        log_step=None, continuum_width=0.1):
+    """
+    Redshift of a spectrum (or of a cube of spectra sharing the same
+    wavelength grid) from the cross-correlation with a template in
+    log-wavelength, computed for all the spectra at once with FFTs
+
+    At each trial redshift, the correlation is the S/N of the amplitude of
+    the (continuum-subtracted) template fitted to the continuum-subtracted
+    spectrum, weighted by the inverse variance, i.e. a matched filter.
+
+    Parameters
+    ----------
+    wl, dwl : numpy arrays
+        Central wavelength and width of each pixel (Ang)
+
+    fluxes, errors : numpy arrays
+        Flux and flux error (F_lambda), either 1D or 2D (n_objects x n_wl)
+
+    template : tuple
+        Rest-frame wavelength (Ang) and F_lambda of the template
+
+    name : str
+        Name of the template, used to cache its Fourier transform
+
+    redshift_range : tuple
+        Minimum and maximum redshift
+
+    log_step : float, optional
+        Step of the log-wavelength grid (by default half the median pixel size)
+
+    continuum_width : float
+        Width (in ln(wl)) of the running median subtracted from the spectra
+        and the template
+
+    Returns
+    -------
+    redshifts : OrderedDict
+        Best redshift ("z_best") and S/N of the correlation peak ("peak"),
+        with shape () or (n_objects,)
+    """
+
+    cube = np.ndim(fluxes) == 2
+    fluxes = np.atleast_2d(fluxes)
+    errors = np.atleast_2d(errors)
+
+    # Log-wavelength grid of the spectra, and linear interpolation weights,
+    # shared by all spectra
+    x0, log_step, n = get_log_grid(wl, log_step)
+    x = x0 + np.arange(n)*log_step
+    j = np.clip(np.searchsorted(np.log(wl), x) - 1, 0, len(wl)-2)
+    frac = np.clip((x-np.log(wl[j])) / (np.log(wl[j+1])-np.log(wl[j])), 0., 1.)
+
+    F = fluxes[:,j]*(1.-frac) + fluxes[:,j+1]*frac
+    E = errors[:,j]*(1.-frac) + errors[:,j+1]*frac
+
+    continuum_pixels = 2*int(0.5*continuum_width/log_step) + 1
+    F -= median_filter(F, size=(1, continuum_pixels), mode='nearest')
+    with np.errstate(divide='ignore'):
+        W = np.where(E > 0., 1./E**2, 0.)
+
+    # Line spread function, in pixels of the log-wavelength grid
+    sigma_pixels = LSF_pixels * np.median(dwl/wl) / (2.*np.sqrt(2.*np.log(2.))) / log_step
+
+    # The template grid starts at the bluest observed wavelength for the
+    # maximum redshift: the shift m corresponds to ln(1+z) = ln(1+z_max) - m*log_step
+    z_min, z_max = redshift_range
+    y0 = x0 - np.log1p(z_max)
+    n_shifts = int(np.floor((np.log1p(z_max)-np.log1p(z_min)) / log_step)) + 1
+    n_template = n + n_shifts
+    n_fft = int(2**np.ceil(np.log2(n_template)))
+
+    T, T2 = get_template_FFT(name, template, y0, log_step, n_template, n_fft,
+            round(sigma_pixels, 6), continuum_pixels)
+
+    numerator = np.fft.irfft(np.conj(np.fft.rfft(W*F, n_fft, axis=1)) * T, n_fft, axis=1)[:,:n_shifts]
+    denominator = np.fft.irfft(np.conj(np.fft.rfft(W, n_fft, axis=1)) * T2, n_fft, axis=1)[:,:n_shifts]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.where(denominator > 0., numerator / np.sqrt(np.abs(denominator)), -np.inf)
+
+    m = np.argmax(correlation, axis=1)
+    rows = np.arange(len(m))
+    peak = correlation[rows,m]
+
+    # Parabolic interpolation around the peak
+    left = correlation[rows,np.maximum(m-1, 0)]
+    right = correlation[rows,np.minimum(m+1, n_shifts-1)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curvature = left - 2.*peak + right
+        shift = np.where((m > 0) & (m < n_shifts-1) & (curvature < 0.), 0.5*(left-right)/curvature, 0.)
+
+    redshifts = OrderedDict()
+    redshifts["z_best"] = np.where(np.isfinite(peak), np.expm1(np.log1p(z_max) - (m+shift)*log_step), -99.99)
+    redshifts["peak"] = np.where(np.isfinite(peak), peak, -99.99)
+
+    if not cube:
+        for key, value in redshifts.iteritems():
+            redshifts[key] = value[0]
+
+    return redshifts
+
+def measure_redshifts_chunk(file_names, template, name, options):
+    """
+    Redshifts of a list of simulated spectra, measuring at once all the
+    spectra sharing the same filter/grating configuration, and comparing
+    them with the input redshift
+
+    Returns
+    -------
+    measurements : list
+        For each spectrum, an OrderedDict with the input redshift, the best
+        redshift, the correlation peak and whether the redshift is recovered
+        within `options["tolerance"]` in dz/(1+z)
+    """
+
+    setups = OrderedDict()
+    for i, file_name in enumerate(file_names):
+        setup = "_".join(os.path.splitext(file_name)[0].split('_')[-2:])
+        setups.setdefault(setup, list()).append(i)
+
+    measurements = [None] * len(file_names)
+    for setup, indices in setups.iteritems():
+        spectra = read_spectra_cube([file_names[i] for i in indices])
+
+        redshifts = measure_redshifts(spectra["wl"], spectra["dwl"], spectra["fluxes"], spectra["errors"],
+                template, name=name, redshift_range=options["redshift_range"],
+                log_step=options["log_step"], continuum_width=options["continuum_width"])
+
+        z_true = spectra["redshift"]
+        success = (redshifts["z_best"] > -99.) & (redshifts["peak"] >= options["peak_threshold"]) & \
+                (np.abs(redshifts["z_best"]-z_true) / (1.+z_true) <= options["tolerance"])
+
+        for k, i in enumerate(indices):
+            measurements[i] = OrderedDict([("redshift", z_true[k]), ("z_best", redshifts["z_best"][k]),
+                ("peak", redshifts["peak"][k]), ("success", success[k])])
+
+    return measurements
+
+def get_output_file_name(folder):
+
+    return os.path.join(folder, "Spectroscopic_redshifts_MC_" + get_MC_draw(folder) + ".fits")
+
+def write_redshifts(file_name, IDs, filters, gratings, measurements):
+
+    cols = list()
+
+    cols.append(fits.Column(name='ID', format='20A', array=IDs))
+    cols.append(fits.Column(name='filter', format='20A', array=filters))
+    cols.append(fits.Column(name='grating', format='20A', array=gratings))
+
+    for key, fmt in (("redshift", 'E'), ("z_best", 'E'), ("peak", 'E'), ("success", 'L')):
+        data = np.array([m[key] for m in measurements])
+        cols.append(fits.Column(name=key, format=fmt, array=data))
+
+    new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+    new_hdu.name = 'REDSHIFTS'
+
+    new_hdulist = fits.HDUList([fits.PrimaryHDU(), new_hdu])
+    new_hdulist.writeto(file_name, overwrite=True)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--folder',
+        help="Parent folder(s) containing the NIRSpec simulations",
+        dest="folders",
+        type=str,
+        nargs='+',
+        required=True
+    )
+
+    parser.add_argument(
+        '--template-file',
+        help="ASCII file containing the rest-frame template (wavelength in Ang, F_lambda). \
+                By default an emission-line template is used",
+        action="store",
+        type=str,
+        dest="template_file"
+    )
+
+    parser.add_argument(
+        '--components-file',
+        help="JSON file containing the components of the lines of the default emission-line template",
+        action="store",
+        type=str,
+        dest="components_file",
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "emission_lines_components.json")
+    )
+
+    parser.add_argument(
+        '--redshift-range',
+        help="Minimum and maximum redshift",
+        action="store",
+        type=float,
+        nargs=2,
+        dest="redshift_range",
+        default=[0., 12.]
+    )
+
+    parser.add_argument(
+        '--log-step',
+        help="Step of the log-wavelength grid (by default half the median pixel size)",
+        action="store",
+        type=float,
+        dest="log_step"
+    )
+
+    parser.add_argument(
+        '--continuum-width',
+        help="Width, in ln(wavelength), of the running median used to subtract the continuum",
+        action="store",
+        type=float,
+        dest="continuum_width",
+        default=0.1
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        help="Maximum |z_best-z|/(1+z) for the redshift to be recovered",
+        action="store",
+        type=float,
+        dest="tolerance",
+        default=0.005
+    )
+
+    parser.add_argument(
+        '--peak-threshold',
+        help="Minimum S/N of the correlation peak for the redshift to be recovered",
+        action="store",
+        type=float,
+        dest="peak_threshold",
+        default=5.
+    )
+
+    parser.add_argument(
+        '--nproc',
+        help="Number of processors to use",
+        action="store",
+        type=int,
+        dest="nproc",
+        default=-1
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        help="Number of spectra processed by each parallel task",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=50
+    )
+
+    args = parser.parse_args()
+
+    if args.template_file is not None:
+        name = os.path.basename(args.template_file)
+        template = read_template(args.template_file)
+    else:
+        name = "emission_lines"
+        template = get_line_template(read_line_components(args.components_file))
+
+    options = {"redshift_range": args.redshift_range, "log_step": args.log_step,
+            "continuum_width": args.continuum_width, "tolerance": args.tolerance,
+            "peak_threshold": args.peak_threshold}
+
+    # Spectra of all folders, processed together
+    simulations = OrderedDict()
+    file_names = list()
+    for folder in args.folders:
+        _file_names, IDs, filters, gratings = list_simulated_spectra(folder)
+        simulations[folder] = (_file_names, IDs, filters, gratings)
+        file_names += _file_names
+
+    chunks = [file_names[i:i+args.chunk_size] for i in range(0, len(file_names), args.chunk_size)]
+
+    if args.nproc <= 0:
+        results = [measure_redshifts_chunk(chunk, template, name, options) for chunk in chunks]
+    else:
+        # Set number of parellel processes to use
+        pool = ProcessingPool(nodes=args.nproc)
+
+        results = pool.map(measure_redshifts_chunk, chunks, (template,)*len(chunks),
+                (name,)*len(chunks), (options,)*len(chunks))
+
+    measured = dict(zip(file_names, [m for result in results for m in result]))
+
+    for folder, (_file_names, IDs, filters, gratings) in simulations.iteritems():
+        measurements = [measured[f] for f in _file_names]
+        print "Folder ", folder, ": ", sum(m["success"] for m in measurements), " redshifts recovered out of ", \
+                len(measurements)
+        write_redshifts(get_output_file_name(folder), IDs, filters, gratings, measurements)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import argparse
+import os
+from astropy.io import fits
+import numpy as np
+
+from compute_emission_line_SN import read_spectra_cube, list_simulated_spectra, get_MC_draw
+
+def get_rest_frame_grid(wl_range, log_step):
+    """
+    Edges of the pixels of a rest-frame grid uniform in ln(wl), covering
+    `wl_range` (Ang)
+    """
+
+    n = int(np.ceil(np.log(wl_range[1]/wl_range[0]) / log_step))
+
+    return wl_range[0] * np.exp(np.arange(n+1)*log_step)
+
+def resample_to_rest_frame(minw, maxw, fluxes, errors, redshifts, rest_edges):
+    """
+    De-redshift a cube of spectra sharing the same (observed) wavelength
+    grid and resample them, conserving the flux, onto the rest-frame grid
+    with pixel edges `rest_edges`, all at once
+
+    The average flux in each rest-frame pixel is the difference of the
+    cumulative integral of the spectrum, linearly interpolated at the
+    (redshifted) pixel edges, i.e. the sum of the observed pixels weighted by
+    the fraction of each of them covered by the rest-frame pixel. The
+    variance is propagated with the squares of the same weights. The
+    covariance between adjacent rest-frame pixels sharing an observed pixel
+    is not returned.
+
+    Returns
+    -------
+    fluxes, errors : numpy arrays
+        Rest-frame F_lambda (i.e. observed F_lambda * (1+z)) and its error,
+        with shape (n_objects, n_pixels) and NaN where the rest-frame pixel
+        is not fully covered by the spectrum
+    """
+
+    fluxes = np.atleast_2d(fluxes)
+    errors = np.atleast_2d(errors)
+    z1 = 1.+np.reshape(redshifts, (-1, 1))
+
+    # Pixel edges of the observed grid, shared by all spectra
+    edges = np.append(minw, maxw[-1])
+    dwl = maxw - minw
+
+    zero = np.zeros((fluxes.shape[0], 1))
+    variance = (errors*dwl)**2
+    cumul_flux = np.concatenate((zero, np.cumsum(fluxes*dwl, axis=1)), axis=1)
+    cumul_variance = np.concatenate((zero, np.cumsum(variance, axis=1)), axis=1)
+
+    # Position of the redshifted rest-frame edges on the observed grid
+    obs_edges = rest_edges[np.newaxis,:] * z1
+    i = np.clip(np.searchsorted(edges, obs_edges) - 1, 0, len(edges)-2)
+    frac = np.clip((obs_edges-edges[i]) / (edges[i+1]-edges[i]), 0., 1.)
+
+    rows = np.arange(fluxes.shape[0])[:,np.newaxis]
+    C = cumul_flux[rows,i] + frac*(cumul_flux[rows,i+1]-cumul_flux[rows,i])
+
+    # The observed pixels i0 and i1 containing the edges of each rest-frame
+    # pixel have weights 1-f0 and f1 (f1-f0 if they coincide), and the
+    # pixels in between have unit weight
+    i0, i1, f0, f1 = i[:,:-1], i[:,1:], frac[:,:-1], frac[:,1:]
+    inner = cumul_variance[rows,i1] - cumul_variance[rows,i0+1]
+    V = np.where(i0 == i1, (f1-f0)**2 * variance[rows,i0],
+            (1.-f0)**2 * variance[rows,i0] + inner + f1**2 * variance[rows,i1])
+
+    width = np.diff(obs_edges, axis=1)
+    covered = (obs_edges[:,:-1] >= edges[0]) & (obs_edges[:,1:] <= edges[-1])
+
+    with np.errstate(invalid='ignore'):
+        rest_fluxes = np.where(covered, np.diff(C, axis=1) / width * z1, np.nan)
+        rest_errors = np.where(covered, np.sqrt(V) / width * z1, np.nan)
+
+    return rest_fluxes, rest_errors
+
+def stack_spectra(file_names, rest_edges, chunk_size=100, normalization=None):
+    """
+    Inverse-variance weighted average of the rest-frame spectra of a list of
+    simulated spectra sharing the same wavelength grid, reading and
+    resampling `chunk_size` spectra at a time, so that only the running sums
+    are kept in memory
+
+    Parameters
+    ----------
+    normalization : list, optional
+        Rest-frame window (Ang) where the average flux of each spectrum is
+        normalized to unity before stacking
+
+    Returns
+    -------
+    stack : OrderedDict
+        Stacked F_lambda ("flux"), its error ("error") and number of spectra
+        contributing to each rest-frame pixel ("N")
+    """
+
+    n_pixels = len(rest_edges) - 1
+    sum_weights = np.zeros(n_pixels)
+    sum_fluxes = np.zeros(n_pixels)
+    N = np.zeros(n_pixels, dtype=int)
+
+    if normalization is not None:
+        rest_wl = 0.5*(rest_edges[1:]+rest_edges[:-1])
+        window = (rest_wl >= normalization[0]) & (rest_wl <= normalization[1])
+
+    for i in range(0, len(file_names), chunk_size):
+        spectra = read_spectra_cube(file_names[i:i+chunk_size])
+
+        fluxes, errors = resample_to_rest_frame(spectra["minw"], spectra["maxw"],
+                spectra["fluxes"], spectra["errors"], spectra["redshift"], rest_edges)
+
+        if normalization is not None:
+            with np.errstate(invalid='ignore'):
+                norm = np.mean(fluxes[:,window], axis=1)
+                norm = np.where(norm > 0., norm, np.nan)[:,np.newaxis]
+            fluxes /= norm
+            errors /= norm
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            valid = np.isfinite(fluxes) & np.isfinite(errors) & (errors > 0.)
+            weights = np.where(valid, 1./errors**2, 0.)
+
+        sum_weights += np.sum(weights, axis=0)
+        sum_fluxes += np.sum(weights*np.where(valid, fluxes, 0.), axis=0)
+        N += np.sum(valid, axis=0)
+
+    stack = OrderedDict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stack["flux"] = np.where(N > 0, sum_fluxes / sum_weights, np.nan)
+        stack["error"] = np.where(N > 0, 1./np.sqrt(sum_weights), np.nan)
+    stack["N"] = N
+
+    return stack
+
+def get_bin_values(file_names, IDs, bin_by="redshift", catalogue=None):
+    """
+    Quantity used to bin the spectra: the `redshift` in the header of the
+    simulated spectra, or a column of the "galaxy properties" extension of
+    the input (Beagle) catalogue, whose i-th row is the object with ID i+1
+    """
+
+    if bin_by == "redshift":
+        return np.array([fits.getheader(f, 1)['redshift'] for f in file_names])
+
+    if catalogue is None:
+        raise ValueError("An input catalogue is required to bin the spectra by `" + bin_by + "`")
+
+    values = fits.getdata(catalogue, 'galaxy properties')[bin_by]
+
+    return np.array([values[int(ID)-1] for ID in IDs])
+
+def get_output_file_name(folder, bin_by):
+
+    return os.path.join(folder, "Stacked_spectra_" + bin_by + "_MC_" + get_MC_draw(folder) + ".fits")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--folder',
+        help="Parent folder(s) containing the NIRSpec simulations",
+        dest="folders",
+        type=str,
+        nargs='+',
+        required=True
+    )
+
+    parser.add_argument(
+        '--output-file',
+        help="Output FITS file (by default in the first folder)",
+        action="store",
+        type=str,
+        dest="output_file"
+    )
+
+    parser.add_argument(
+        '--filter',
+        help="Filter of the spectra to stack",
+        action="store",
+        type=str,
+        dest="FWA",
+        default="CLEAR"
+    )
+
+    parser.add_argument(
+        '--grating',
+        help="Grating of the spectra to stack",
+        action="store",
+        type=str,
+        dest="GWA",
+        default="PRISM"
+    )
+
+    parser.add_argument(
+        '--bin-by',
+        help="Quantity used to bin the spectra, either `redshift` or a column of the \
+                `galaxy properties` extension of the input catalogue (e.g. the stellar mass)",
+        action="store",
+        type=str,
+        dest="bin_by",
+        default="redshift"
+    )
+
+    parser.add_argument(
+        '--bins',
+        help="Edges of the bins",
+        action="store",
+        type=float,
+        nargs='+',
+        dest="bins",
+        required=True
+    )
+
+    parser.add_argument(
+        '-i', '--input-catalogue',
+        help="FITS catalogue of the input SEDs (required to bin by a quantity other than the redshift)",
+        action="store",
+        type=str,
+        dest="input_catalogue"
+    )
+
+    parser.add_argument(
+        '--wl-range',
+        help="Minimum and maximum rest-frame wavelength (Ang) of the stacks",
+        action="store",
+        type=float,
+        nargs=2,
+        dest="wl_range",
+        default=[1000., 10000.]
+    )
+
+    parser.add_argument(
+        '--log-step',
+        help="Step, in ln(wavelength), of the rest-frame grid of the stacks",
+        action="store",
+        type=float,
+        dest="log_step",
+        default=2.E-03
+    )
+
+    parser.add_argument(
+        '--normalize',
+        help="Rest-frame window (Ang) where the spectra are normalized before stacking",
+        action="store",
+        type=float,
+        nargs=2,
+        dest="normalization"
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        help="Number of spectra read and resampled at once",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=100
+    )
+
+    args = parser.parse_args()
+
+    file_names, IDs = list(), list()
+    for folder in args.folders:
+        _file_names, _IDs, filters, gratings = list_simulated_spectra(folder)
+        for f, ID, FWA, GWA in zip(_file_names, _IDs, filters, gratings):
+            if FWA == args.FWA and GWA == args.GWA:
+                file_names.append(f)
+                IDs.append(ID)
+
+    values = get_bin_values(file_names, IDs, bin_by=args.bin_by, catalogue=args.input_catalogue)
+    bins = np.digitize(values, args.bins)
+
+    rest_edges = get_rest_frame_grid(args.wl_range, args.log_step)
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = get_output_file_name(args.folders[0], args.bin_by)
+
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
+    hdulist[0].header['BIN_BY'] = args.bin_by
+    hdulist[0].header['FWA'] = args.FWA
+    hdulist[0].header['GWA'] = args.GWA
+    hdulist.writeto(output_file, overwrite=True)
+
+    # Each bin is stacked reading its spectra in chunks, and appended to the
+    # output file as soon as it is computed
+    for b in range(1, len(args.bins)):
+        members = [f for f, _b in zip(file_names, bins) if _b == b]
+
+        stack = stack_spectra(members, rest_edges, chunk_size=args.chunk_size,
+                normalization=args.normalization)
+
+        cols = list()
+        cols.append(fits.Column(name='wl', format='D', array=np.sqrt(rest_edges[1:]*rest_edges[:-1])))
+        cols.append(fits.Column(name='flux', format='E', array=stack["flux"]))
+        cols.append(fits.Column(name='error', format='E', array=stack["error"]))
+        cols.append(fits.Column(name='N', format='J', array=stack["N"]))
+
+        new_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+        new_hdu.name = 'BIN_' + str(b)
+        new_hdu.header['BIN_MIN'] = args.bins[b-1]
+        new_hdu.header['BIN_MAX'] = args.bins[b]
+        new_hdu.header['NSPEC'] = len(members)
+
+        fits.append(output_file, new_hdu.data, new_hdu.header)
+
+        print "Bin ", args.bins[b-1], "-", args.bins[b], ": ", len(members), " spectra stacked"
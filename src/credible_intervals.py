@@ -1,27 +1,521 @@
 # External modules.
+from collections import OrderedDict
+import ast
+import itertools
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.optimize import brentq
+from scipy.interpolate import interp1d, RegularGridInterpolator
 from scipy.integrate import simps
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
 
 # Internal modules.
 import WeightedKDE
 
-# This value is the minimum relative probability used when setting the axes
-# limits and building the grid of points where to compute the PDF
+def get_weighted_quantiles(values, probability, quantiles, lengths=None):
+    """ 
+    Weighted quantiles of several parameters at once, from the cumulative
+    probability of the sorted values of each parameter, interpolated
+    linearly (as with interp1d(cumulative probability, sorted values))
+
+    Parameters
+    ----------
+    values : numpy array
+        Values of the parameters, with shape (n_samples,) or (n_samples,
+        n_parameters)
+
+    probability : numpy array
+        Probability (weight) of each sample, with shape (n_samples,)
+
+    quantiles : list of float
+        Quantiles to compute, e.g. [0.16, 0.5, 0.84]
+
+    lengths : list of int, optional
+        Ragged mode: the samples are the concatenation of the samples of
+        several objects, with `lengths` samples each, and the quantiles are
+        computed for each object separately
+
+    Returns
+    -------
+    values : numpy array
+        Quantiles, with shape (n_quantiles,) + (n_parameters,), preceded by
+        (n_objects,) in ragged mode (the parameter axis is only present if
+        `values` is 2D)
+    """
+
+    values = np.asarray(values)
+    one_parameter = values.ndim == 1
+    values = np.reshape(values, (values.shape[0], -1))
+    probability = np.asarray(probability, dtype=np.float64)
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+
+    n_samples, n_parameters = values.shape
+    ragged = lengths is not None
+    if not ragged:
+        lengths = [n_samples]
+    lengths = np.asarray(lengths, dtype=int)
+    n_objects = len(lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    objects = np.repeat(np.arange(n_objects), lengths)
+
+    # One sort per parameter, by object and then by value
+    if n_objects == 1:
+        order = np.argsort(values, axis=0)
+    else:
+        order = np.array([np.lexsort((values[:,j], objects)) for j in range(n_parameters)]).T
+    sorted_values = values[order, np.arange(n_parameters)]
+
+    # Cumulative probability of each object, normalized to unity
+    cumul = np.cumsum(probability[order], axis=0)
+    previous = np.where(starts > 0, cumul[np.maximum(starts-1, 0),:].T, 0.).T
+    total = cumul[starts+lengths-1,:] - previous
+    cumul = (cumul - previous[objects,:]) / total[objects,:]
+
+    # Shift the cumulative probability of each (object, parameter) by an
+    # offset, so that a single binary search finds all the quantiles
+    offsets = 2.*(np.arange(n_parameters)*n_objects + objects[:,np.newaxis])
+    flat = np.ravel(cumul + offsets, order='F')
+
+    q = np.clip(quantiles[np.newaxis,:,np.newaxis], cumul[starts,np.newaxis,:], 1.)
+    targets = q + 2.*(np.arange(n_parameters)*n_objects + np.arange(n_objects)[:,np.newaxis,np.newaxis])
+
+    # Position in the flattened (column-major) array
+    column_starts = (np.arange(n_parameters)*n_samples)[np.newaxis,np.newaxis,:] + starts[:,np.newaxis,np.newaxis]
+    column_ends = column_starts + lengths[:,np.newaxis,np.newaxis] - 1
+    hi = np.clip(np.searchsorted(flat, np.ravel(targets)).reshape(targets.shape), 
+            np.minimum(column_starts+1, column_ends), column_ends)
+    lo = np.maximum(hi-1, column_starts)
+
+    x_lo, x_hi = flat[lo], flat[hi]
+    y = np.ravel(sorted_values, order='F')
+    y_lo, y_hi = y[lo], y[hi]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(x_hi > x_lo, (y_hi-y_lo)/(x_hi-x_lo), 0.)
+    result = y_lo + slope*(targets-x_lo)
+
+    if one_parameter:
+        result = result[...,0]
+    if not ragged:
+        result = result[0]
+
+    return result
+
+def get_credible_intervals(values, probability, levels=(68., 95.), lengths=None):
+    """ 
+    Mean, median and central credible intervals of several parameters (and
+    objects, in ragged mode) at once, see `get_weighted_quantiles`
+
+    Returns
+    -------
+    output : OrderedDict
+        "mean" and "median", with shape (n_parameters,) (preceded by
+        (n_objects,) in ragged mode), and "regions", an OrderedDict with the
+        lower and upper limits of the interval for each (percentage) level,
+        with shape (n_parameters, 2)
+    """
+
+    values = np.asarray(values)
+    probability = np.asarray(probability, dtype=np.float64)
+
+    quantiles = [0.5]
+    for level in levels:
+        quantiles += [0.5*(1.-level/100.), 1.-0.5*(1.-level/100.)]
+
+    q = get_weighted_quantiles(values, probability, quantiles, lengths=lengths)
+
+    # Put the quantiles along the last axis
+    q = np.moveaxis(q, 0 if lengths is None else 1, -1)
+
+    if lengths is None:
+        lengths = [len(probability)]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    weighted = probability[:,np.newaxis] * np.reshape(values, (len(probability), -1))
+    mean = np.add.reduceat(weighted, starts, axis=0) / np.add.reduceat(probability, starts)[:,np.newaxis]
+    if values.ndim == 1:
+        mean = mean[:,0]
+    if q.ndim == mean.ndim:
+        mean = mean[0]
+
+    output = OrderedDict()
+    output["mean"] = mean
+    output["median"] = q[...,0]
+    output["regions"] = OrderedDict()
+    for i, level in enumerate(levels):
+        output["regions"][str(level)] = q[...,1+2*i:3+2*i]
+
+    return output
+
+# Operators and functions allowed in the expressions of derived quantities
+_binary_operators = {
+        ast.Add: np.add,
+        ast.Sub: np.subtract,
+        ast.Mult: np.multiply,
+        ast.Div: np.true_divide,
+        ast.Pow: np.power
+        }
+
+_unary_operators = {
+        ast.USub: np.negative,
+        ast.UAdd: np.positive
+        }
+
+_functions = {
+        "log10": np.log10,
+        "log": np.log,
+        "exp": np.exp,
+        "sqrt": np.sqrt,
+        "abs": np.abs
+        }
+
+def parse_expression(expression):
+    """ 
+    Parse the expression of a derived quantity, e.g. "log10(SFR/M_star)",
+    made of column names, numbers, the operators + - * / ** and the
+    functions log10, log, exp, sqrt and abs
+
+    Returns
+    -------
+    tree : ast.Expression
+        Parsed expression
+
+    names : list of str
+        Column names appearing in the expression
+    """
+
+    tree = ast.parse(expression.strip(), mode='eval')
+
+    names = list()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in _functions and node.id not in names:
+                names.append(node.id)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _functions \
+                    or len(node.args) != 1:
+                raise ValueError("Unsupported function call in expression `" + expression + "`")
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in _binary_operators:
+                raise ValueError("Unsupported operator in expression `" + expression + "`")
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in _unary_operators:
+                raise ValueError("Unsupported operator in expression `" + expression + "`")
+        elif not isinstance(node, (ast.Expression, ast.Num, ast.Load, ast.operator, ast.unaryop)):
+            raise ValueError("Unsupported syntax in expression `" + expression + "`")
+
+    return tree, names
+
+def _evaluate_node(node, columns, chunk):
+    """ 
+    Evaluate a node of a parsed expression on the rows `chunk` of the
+    columns, writing the result of each operation in place into a temporary
+    array produced by an operand, when there is one. Returns the value and
+    whether it is a temporary array that can be overwritten.
+    """
+
+    if isinstance(node, ast.Expression):
+        return _evaluate_node(node.body, columns, chunk)
+
+    if isinstance(node, ast.Num):
+        return float(node.n), False
+
+    if isinstance(node, ast.Name):
+        column = columns[node.id][chunk]
+        value = np.asarray(column, dtype=np.float64)
+        return value, value is not column
+
+    if isinstance(node, ast.BinOp):
+        ufunc = _binary_operators[type(node.op)]
+        operands = [_evaluate_node(node.left, columns, chunk), _evaluate_node(node.right, columns, chunk)]
+    elif isinstance(node, ast.UnaryOp):
+        ufunc = _unary_operators[type(node.op)]
+        operands = [_evaluate_node(node.operand, columns, chunk)]
+    else:
+        ufunc = _functions[node.func.id]
+        operands = [_evaluate_node(node.args[0], columns, chunk)]
+
+    args = [value for value, temporary in operands]
+    for value, temporary in operands:
+        if temporary:
+            return ufunc(*args, out=value), True
+
+    value = ufunc(*args)
+
+    return value, np.ndim(value) > 0
+
+def evaluate_expressions(expressions, columns, n_samples, chunk_size=100000):
+    """ 
+    Evaluate the expressions of several derived quantities over named
+    columns of posterior samples, `chunk_size` rows at a time, so that the
+    intermediate arrays never exceed the size of a chunk
+
+    Parameters
+    ----------
+    expressions : list of str
+        Expressions of the derived quantities, see `parse_expression`
+
+    columns : dict or FITS_rec
+        Columns of the posterior samples, indexed by name
+
+    n_samples : int
+        Number of posterior samples (rows of the columns)
+
+    Returns
+    -------
+    values : numpy array
+        Derived quantities, with shape (n_samples, n_expressions)
+    """
+
+    trees = [parse_expression(expression)[0] for expression in expressions]
+
+    # Column-major, so that each derived quantity is contiguous
+    values = np.empty((n_samples, len(trees)), order='F')
+
+    for start in range(0, n_samples, chunk_size):
+        chunk = slice(start, min(start+chunk_size, n_samples))
+        for j, tree in enumerate(trees):
+            values[chunk,j], _ = _evaluate_node(tree, columns, chunk)
+
+    return values
+
+def get_derived_credible_intervals(expressions, columns, probability, levels=(68., 95.),
+        lengths=None, chunk_size=100000):
+    """ 
+    Mean, median and central credible intervals of derived quantities, given
+    as expressions over named columns of posterior samples (e.g. the sSFR,
+    "log10(SFR/M_star)"), see `evaluate_expressions` and
+    `get_credible_intervals`
+    """
+
+    values = evaluate_expressions(expressions, columns, len(probability), chunk_size=chunk_size)
+
+    return get_credible_intervals(values, probability, levels=levels, lengths=lengths)
+
+def get_HPD_membership(data, probability, levels, k=20):
+    """ 
+    Posterior samples inside the highest posterior density (HPD) credible
+    regions of a distribution of any dimension, without computing the PDF on
+    a grid
+
+    The density at each sample is estimated from its k nearest neighbours,
+    as the probability of the neighbours divided by the volume of the sphere
+    enclosing them, after whitening the samples with their (weighted)
+    covariance matrix. The samples are then ranked by decreasing density and
+    the region enclosing the probability `level` is made of the densest
+    samples whose cumulative probability does not exceed `level`.
+
+    Parameters
+    ----------
+    data : numpy array
+        Posterior samples, with shape (n_dims, n_samples) (or (n_samples,) in 1D)
+
+    probability : numpy array
+        Posterior probability (weight) of each sample
+
+    levels : list of float
+        Probability enclosed by each credible region (e.g. [0.68, 0.95])
+
+    k : int, optional
+        Number of nearest neighbours used to estimate the density
+
+    Returns
+    -------
+    members : numpy array
+        Boolean array of shape (n_levels, n_samples), True for the samples
+        inside each credible region
+    """
+
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    probability = np.asarray(probability, dtype=np.float64)
+    probability = probability / np.sum(probability)
+    n_dims, n_samples = data.shape
+    k = min(k, n_samples-1)
+
+    # Whiten the samples, so that the distances do not depend on the units
+    # of the different parameters
+    covariance = np.atleast_2d(np.cov(data, aweights=probability))
+    try:
+        L = np.linalg.cholesky(covariance)
+        x = np.linalg.solve(L, data - np.dot(data, probability)[:,np.newaxis]).T
+    except np.linalg.LinAlgError:
+        scale = np.sqrt(np.diag(covariance))
+        x = (data / np.where(scale > 0., scale, 1.)[:,np.newaxis]).T
+
+    # Distance to the k-th neighbour (the first one being the sample itself)
+    distances, neighbours = cKDTree(x).query(x, k=k+1)
+
+    # Identical samples would have infinite density
+    r = distances[:,-1]
+    r = np.maximum(r, np.amin(r[r > 0.]) if np.any(r > 0.) else 1.)
+
+    with np.errstate(divide='ignore'):
+        log_density = np.log(np.sum(probability[neighbours], axis=1)) - n_dims*np.log(r)
+
+    # Cumulative probability of the samples denser than each sample
+    sort_ = np.argsort(-log_density, kind='mergesort')
+    cumul = np.empty(n_samples)
+    cumul[sort_] = np.cumsum(probability[sort_]) - probability[sort_]
+
+    return cumul[np.newaxis,:] < np.reshape(levels, (-1, 1))
+
+# Maximum number of cells of the (padded) binning grid plus the kernel of
+# `binned_kde`: beyond this, e.g. for a kernel much wider than the grid
+# step, CredibleInterval falls back to the exact KDE
+max_binned_kde_size = 2**22
+
+def get_binning_grid(grids, sigma, n_sigma=4., oversampling=3., max_oversampling=32):
+    """ 
+    Binning grid of `binned_kde` along each dimension: the requested grid,
+    refined by an integer factor and extended by n_sigma kernel standard
+    deviations on both sides
+
+    Returns
+    -------
+    origins, steps, sizes, strides, offsets : lists
+        First node, step, number of nodes, refinement factor, and number of
+        nodes added on each side, along each dimension
+    """
+
+    origins, steps, sizes, strides, offsets = list(), list(), list(), list(), list()
+    for grid, s in zip(grids, sigma):
+        step = grid[1] - grid[0]
+        m = int(min(max_oversampling, max(1, np.ceil(oversampling*step/s))))
+        step /= m
+        n_extend = int(np.ceil(n_sigma*s/step))
+        origins.append(grid[0] - n_extend*step)
+        steps.append(step)
+        sizes.append((len(grid)-1)*m + 1 + 2*n_extend)
+        strides.append(m)
+        offsets.append(n_extend)
+
+    return origins, steps, sizes, strides, offsets
+
+def get_binned_kde_size(grids, covariance, **kwargs):
+    """ 
+    Number of cells of the binning grid plus the kernel of `binned_kde`,
+    which sets its memory footprint
+    """
+
+    sigma = np.sqrt(np.diag(np.atleast_2d(covariance)))
+    origins, steps, sizes, strides, offsets = get_binning_grid(grids, sigma, **kwargs)
+
+    return np.prod(sizes, dtype=np.float64) + np.prod(2.*np.array(offsets)+1.)
+
+def binned_kde(grids, data, weights, covariance, n_sigma=4., oversampling=3., max_oversampling=32,
+        max_size=max_binned_kde_size):
+    """ 
+    Weighted Gaussian kernel density estimate on a regular grid, computed by
+    linear binning of the samples followed by an FFT convolution with the
+    kernel, i.e. in O(N + G log G) rather than O(N x G)
+
+    Parameters
+    ----------
+    grids : tuple
+        Regular grid of points along each dimension
+
+    data : numpy array
+        Samples, with shape (n_dimensions, n_samples)
+
+    weights : numpy array
+        Weights of the samples
+
+    covariance : numpy array
+        Covariance matrix of the Gaussian kernel (e.g. the `covariance` of a
+        WeightedKDE.gaussian_kde, to use the same bandwidth)
+
+    n_sigma : float
+        Extent of the kernel, in units of its standard deviation. The grid is
+        extended by the same amount, so that samples outside the grid still
+        contribute to the density close to its edges.
+
+    oversampling : float
+        Minimum number of pixels of the binning grid per kernel standard
+        deviation: when the grid is coarser than this, the samples are
+        binned on a finer grid containing the requested points
+
+    max_size : int
+        Maximum number of cells of the binning grid plus the kernel (see
+        `get_binned_kde_size`), a ValueError is raised beyond it
+
+    Returns
+    -------
+    pdf : numpy array
+        Density at the grid points, with shape (len(grids[0]), len(grids[1]), ...)
+    """
+
+    data = np.atleast_2d(data)
+    covariance = np.atleast_2d(covariance)
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+    n_dim = data.shape[0]
+
+    sigma = np.sqrt(np.diag(covariance))
+
+    # Binning grid along each dimension
+    origins, steps, sizes, strides, offsets = get_binning_grid(grids, sigma, n_sigma=n_sigma, 
+            oversampling=oversampling, max_oversampling=max_oversampling)
+
+    size = np.prod(sizes, dtype=np.float64) + np.prod(2.*np.array(offsets)+1.)
+    if size > max_size:
+        raise ValueError("The binned KDE requires " + str(int(size)) + " cells, more than the maximum " 
+                + str(int(max_size)) + ", use the exact KDE instead")
+
+    # Linear binning: each sample is shared among the 2^n_dim closest nodes
+    binned = np.zeros(sizes)
+    position = (data - np.reshape(origins, (-1, 1))) / np.reshape(steps, (-1, 1))
+    index = np.floor(position).astype(int)
+    frac = position - index
+    for corner in itertools.product((0, 1), repeat=n_dim):
+        w = np.copy(weights)
+        nodes = list()
+        for d, c in enumerate(corner):
+            w *= frac[d] if c else 1.-frac[d]
+            nodes.append(index[d] + c)
+        inside = np.all([(i >= 0) & (i < n) for i, n in zip(nodes, sizes)], axis=0)
+        flat = np.ravel_multi_index([i[inside] for i in nodes], sizes)
+        binned += np.reshape(np.bincount(flat, weights=w[inside], minlength=binned.size), sizes)
+
+    # Gaussian kernel sampled on the binning grid
+    axes = [np.arange(-o, o+1)*step for o, step in zip(offsets, steps)]
+    mesh = np.meshgrid(*axes, indexing='ij')
+    d = np.array([np.ravel(x) for x in mesh])
+    inverse = np.linalg.inv(covariance)
+    kernel = np.exp(-0.5*np.sum(d*np.dot(inverse, d), axis=0)) \
+            / np.sqrt((2.*np.pi)**n_dim * np.linalg.det(covariance))
+    kernel = np.reshape(kernel, mesh[0].shape)
+
+    pdf = fftconvolve(binned, kernel, mode='same')
+
+    # Density at the requested grid points
+    slices = tuple(slice(o, o+(len(grid)-1)*m+1, m) for o, m, grid in zip(offsets, strides, grids))
+
+    return np.clip(pdf[slices], 0., None)
 
 class CredibleInterval:
 
-    def __init__(self, data, probability):
+    def __init__(self, data, probability, kde_method="binned"):
+        """ 
+        Arguments:
+
+        data            -- Posterior samples, with shape (n_samples,) or (n_dims, n_samples)
+
+        probability     -- Posterior probability (weight) of each sample
+
+        kde_method      -- "binned" to compute the KDE on the grid by linear
+                           binning and FFT convolution, "exact" to evaluate
+                           the weighted Gaussian KDE at each grid point
+        """
 
         # Copy the posterior probability, likelihood and parameter values
         self.data = np.array(data)
 
         self.probability = np.array(probability)
 
+        self.kde_method = kde_method
+
+        # In more than 2D the credible regions are computed from the samples
+        # alone, see `get_HPD_membership`
         if self.data.ndim == 1:
             self.ComputeKDE1D()
-        elif self.data.ndim == 2:
+        elif self.data.ndim == 2 and self.data.shape[0] == 2:
             self.ComputeKDE2D()
 
     def ComputeKDE1D(self,
@@ -41,7 +535,11 @@ class CredibleInterval:
         # Now consider a regular grid of the parameter x
         self.x_grid = np.linspace(self.min_x, self.max_x, nXgrid)
 
-        self.kde_pdf_grid = self.kde_pdf(self.x_grid)
+        if self.use_binned_kde():
+            self.kde_pdf_grid = binned_kde((self.x_grid,), self.data, self.probability, 
+                    self.kde_pdf.covariance)
+        else:
+            self.kde_pdf_grid = self.kde_pdf(self.x_grid)
 
         # Reshape the pdf on the grid
         self.kde_pdf_grid = np.array(self.kde_pdf_grid)
@@ -53,6 +551,29 @@ class CredibleInterval:
         # Normalize the PDF
         self.kde_pdf_grid /= self.kde_pdf_norm
 
+    def use_binned_kde(self):
+
+        if self.kde_method == "exact":
+            return False
+        elif self.kde_method != "binned":
+            raise ValueError("KDE method `" + self.kde_method + "` not recognized")
+
+        # The binned KDE requires a non-degenerate grid and kernel
+        covariance = np.atleast_2d(self.kde_pdf.covariance)
+        if self.data.ndim == 1:
+            widths = (self.max_x-self.min_x,)
+            grids = (self.x_grid,)
+        else:
+            widths = (self.max_x-self.min_x, self.max_y-self.min_y)
+            grids = (self.x_grid, self.y_grid)
+
+        if not (min(widths) > 0. and np.all(np.diag(covariance) > 0.) and np.linalg.det(covariance) > 0.):
+            return False
+
+        # A kernel much wider than the grid step would require a very large
+        # padded binning grid, in which case the exact KDE is cheaper
+        return get_binned_kde_size(grids, covariance) <= max_binned_kde_size
+
     def GetCumulativeIntegral(self):
 
         self.cumul_pdf = np.cumsum(self.kde_pdf_grid)
@@ -69,16 +590,9 @@ class CredibleInterval:
 
         """
 
-        # Check if the interpolant of the cumulative integral of the marginal PDF already exists
-        try:
-            interp_cumulpdf = self.interp_cumul_pdf
-        except AttributeError:
-            self.GetCumulativeIntegral()
-            interp_cumulpdf = self.interp_cumul_pdf
-
         # Posterior median is the value of param that corresponds to a cumulative
         # probability = 0.5
-        median = self.interp_cumul_pdf(0.5)
+        median = get_weighted_quantiles(self.x_grid, self.kde_pdf_grid, [0.5])[0]
 
         return median
 
@@ -89,28 +603,18 @@ class CredibleInterval:
 
         """
 
-        # Check if the interpolant of the cumulative integral of the marginal PDF already exists
-        try:
-            interp_cumul_pdf = self.interp_cumul_pdf
-        except AttributeError:
-            self.GetCumulativeIntegral()
-            interp_cumul_pdf = self.interp_cumul_pdf
-
-        # Check if the posterior median has been computed or not
-        try:
-            posterior_median = self.posterior_median
-        except AttributeError:
-            posterior_median = self.interp_cumul_pdf(0.5)
-
-        # Plot credible regions intervals above data.
-        limits = list()
+        # All the limits are computed at once from the cumulative integral of
+        # the PDF on the grid
+        quantiles = list()
         for level in levels:
             half_level = 0.5 * (1.0-level)
+            quantiles += [half_level, 1.-half_level]
 
-            low = interp_cumul_pdf(half_level)
-            up = interp_cumul_pdf(1.-half_level)
+        values = get_weighted_quantiles(self.x_grid, self.kde_pdf_grid, quantiles)
 
-            limits.append((low, up))
+        limits = list()
+        for i in range(len(levels)):
+            limits.append((values[2*i], values[2*i+1]))
 
         return limits
 
@@ -139,7 +643,13 @@ class CredibleInterval:
 
         self.xx_grid, self.yy_grid = np.meshgrid(self.x_grid, self.y_grid)
 
-        self.kde_pdf_grid =  self.kde_pdf((np.ravel(self.xx_grid), np.ravel(self.yy_grid)))
+        if self.use_binned_kde():
+            # The binned KDE has shape (nXgrid, nYgrid), while the grid built
+            # by meshgrid has shape (nYgrid, nXgrid)
+            self.kde_pdf_grid = binned_kde((self.x_grid, self.y_grid), self.data, self.probability, 
+                    self.kde_pdf.covariance).T
+        else:
+            self.kde_pdf_grid =  self.kde_pdf((np.ravel(self.xx_grid), np.ravel(self.yy_grid)))
 
         # Reshape the pdf on the grid
         self.kde_pdf_grid = np.reshape(self.kde_pdf_grid, self.xx_grid.shape)
@@ -157,38 +667,92 @@ class CredibleInterval:
     def GetProbabilityFor2DCredibleRegion(self,
             levels):
 
-        """ Plot the posterior mean
+        """ Density of the isocontours enclosing the credible regions
+
+        Arguments:
+
+        levels     -- Probability enclosed by each credible region (e.g. (0.68, 0.95))
+
+        """
+
+        # Probability mass of each grid cell, with trapezoidal weights (the
+        # cells at the edges of the grid have half the width)
+        weights_x = np.gradient(self.x_grid)
+        weights_x[[0,-1]] *= 0.5
+        weights_y = np.gradient(self.y_grid)
+        weights_y[[0,-1]] *= 0.5
+
+        pdf = np.ravel(self.kde_pdf_grid)
+        mass = np.ravel(self.kde_pdf_grid * weights_y[:,np.newaxis] * weights_x[np.newaxis,:])
+
+        # Sort the cells by decreasing density: the mass enclosed by the
+        # isocontour at density t is the cumulative mass of the cells with
+        # density >= t
+        order = np.argsort(pdf)[::-1]
+        sorted_pdf = pdf[order]
+        cumul_mass = np.cumsum(mass[order])
+
+        total = cumul_mass[-1]
+        if not (np.isfinite(total) and total > 0.):
+            raise ValueError("The probability mass on the KDE grid is " + str(total) + 
+                    ", cannot compute the 2D credible regions")
+        cumul_mass /= total
+
+        # For each level, density at which the enclosed mass reaches the
+        # level, interpolated linearly between consecutive cells (cells with
+        # zero mass do not change the enclosed mass)
+        i = np.clip(np.searchsorted(cumul_mass, levels), 1, len(pdf)-1)
+        delta = cumul_mass[i]-cumul_mass[i-1]
+        frac = np.ones(len(i))
+        ok = delta > 0.
+        frac[ok] = (np.asarray(levels)[ok]-cumul_mass[i-1][ok]) / delta[ok]
+        isocontourLevel = list(sorted_pdf[i-1] + np.clip(frac, 0., 1.)*(sorted_pdf[i]-sorted_pdf[i-1]))
+
+        return isocontourLevel
+
+    def GetPDFAtSamples(self, data=None):
+        """ Density at the posterior samples (or at the points `data`),
+        interpolated linearly on the grid where the KDE is computed, and zero
+        outside the grid
 
         Arguments:
 
-        CredibleRegions     -- Class containing the definitions for plotting credible regions
+        data     -- Points with shape (n,) or (2, n), by default the posterior samples
 
         """
 
-        # Plot credible regions intervals above data.
+        if data is None:
+            data = self.data
+        data = np.array(data)
 
-        isocontourLevel = list()
-        colors = list()
-        labels= list()
-        linewidths = list()
-        max_pdf = max(np.ravel(self.kde_pdf_grid)) 
+        if data.ndim == 1:
+            return np.interp(data, self.x_grid, self.kde_pdf_grid, left=0., right=0.)
 
-        for level in levels:
-            
-            # Parametric integral: you compute the integral for all values of
-            # probability >= t
-            def f_integral(t):
-                temp_grid = np.copy(self.kde_pdf_grid)
-                temp_grid[temp_grid < t] = 0.
-                i = simps(simps(temp_grid,self.y_grid), self.x_grid)
-                return i-level
-
-            # Root finding algorithm to search for the zero of the function,
-            # i.e. to seach for the value of the parameter "t" for which the
-            # integral of the PDF is equal to "levels[j]" (and hence the
-            # difference (integral-levels[j]) = 0)
-            isocontourLevel.append(brentq(f_integral, 0., max_pdf))
+        # kde_pdf_grid has shape (nYgrid, nXgrid)
+        interpolant = RegularGridInterpolator((self.y_grid, self.x_grid), self.kde_pdf_grid, 
+                bounds_error=False, fill_value=0.)
 
+        return interpolant(np.column_stack((data[1,:], data[0,:])))
 
-        return isocontourLevel
+    def GetSamplesInCredibleRegion(self, level):
+        """ Boolean mask of the posterior samples inside the credible region
+        enclosing the probability `level`, i.e. within the central interval
+        in 1D, within the highest density isocontour in 2D, and among the
+        highest density samples (see `get_HPD_membership`) in N-D
+
+        Arguments:
+
+        level     -- Probability enclosed by the credible region (e.g. 0.68)
+
+        """
+
+        if self.data.ndim == 1:
+            low, up = self.Get1DCredibleRegion(levels=(level,))[0]
+            return (self.data >= low) & (self.data <= up)
+
+        if self.data.shape[0] > 2:
+            return get_HPD_membership(self.data, self.probability, (level,))[0]
+
+        prob_level = self.GetProbabilityFor2DCredibleRegion(levels=(level,))[0]
 
+        return self.GetPDFAtSamples() >= prob_level
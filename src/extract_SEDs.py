@@ -50,36 +50,124 @@ nanoJy = np.float32(1.E-23 * 1.E-09)
 show_plot = False
 
 # taken from https://github.com/eclake/WG3_NIRSpec/blob/a3ade5286aea8d73bc07a6dbbfd24969a4f6eab2/SF%20Q%20separation.ipynb
-# Kevin Hainline employed the Whitaker+ 11 colour-cut criteria
-def UVJ_separation(redshift, UV, VJ): # returns 1 for quiescent, 0 for star-forming
-    if redshift > 4:
-        return -1
-    if redshift < 0.5:
-        if (UV > 0.88*VJ+0.69 and UV > 1.3 and VJ < 1.6):
-            #print 'yes'
-            return 1
-        else:
-            return 0
-    if redshift >= 0.5 and redshift < 1.5:
-        if (UV > 0.88*VJ+0.59 and UV > 1.3 and VJ < 1.6):
-            #print 'yes'
-            return 1
-        else:
-            return 0
-    if redshift >= 1.5 and redshift < 2.0:
-        if (UV > 0.88*VJ+0.59 and UV > 1.3 and VJ < 1.5):
-            #print 'yes'
-            return 1
-        else:
-            return 0
-    if redshift >= 2 and redshift < 4:
-        if (UV > 0.88*VJ+0.59 and UV > 1.2 and VJ < 1.4):
-            #print 'yes'
-            return 1
-        else:
-            return 0
+# Kevin Hainline employed the Whitaker+ 11 colour-cut criteria: in each
+# redshift bin, quiescent galaxies have U-V > slope*(V-J)+intercept, U-V >
+# UV_min and V-J < VJ_max. The "redshift_edges" separate the bins, and
+# galaxies beyond the last edge are not classified. The default cuts are
+# read from this JSON file
+UVJ_cuts_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "UVJ_cuts_Whitaker11.json")
+
+def read_UVJ_cuts(file_name):
+
+    with open(file_name) as f:
+        cuts = json.load(f, object_pairs_hook=OrderedDict)
+
+    n_bins = len(cuts["redshift_edges"])
+    for key in ("slope", "intercept", "UV_min", "VJ_max"):
+        if len(cuts[key]) != n_bins:
+            raise ValueError('The UVJ cuts must contain one `'+key+'` for each of the '+str(n_bins)+' redshift bins!')
+
+    return cuts
+
+UVJ_cuts_Whitaker11 = read_UVJ_cuts(UVJ_cuts_file)
+
+def UVJ_classification(redshift, UV, VJ, cuts=None): 
+    # returns 1 for quiescent, 0 for star-forming, -1 for galaxies outside
+    # the redshift range of the cuts, for all the input galaxies at once
+
+    if cuts is None:
+        cuts = UVJ_cuts_Whitaker11
 
+    redshift = np.asarray(redshift)
+    UV = np.asarray(UV)
+    VJ = np.asarray(VJ)
 
+    # Bin i contains redshift_edges[i-1] <= z < redshift_edges[i]
+    edges = cuts["redshift_edges"]
+    bins = np.minimum(np.digitize(redshift, edges), len(edges)-1)
+
+    slope = np.asarray(cuts["slope"])[bins]
+    intercept = np.asarray(cuts["intercept"])[bins]
+    UV_min = np.asarray(cuts["UV_min"])[bins]
+    VJ_max = np.asarray(cuts["VJ_max"])[bins]
+
+    quiescent = (UV > slope*VJ+intercept) & (UV > UV_min) & (VJ < VJ_max)
+
+    return np.where(redshift >= edges[-1], -1, quiescent.astype(int))
+
+def UVJ_separation(redshift, UV, VJ, cuts=None): # returns 1 for quiescent, 0 for star-forming
+
+    return int(UVJ_classification(redshift, UV, VJ, cuts=cuts))
+
+
+# ****************************************************************************************
+def get_params_ranges_mask(hdulist, params_ranges, n_min):
+    # Mask of the rows of a Beagle output file whose parameters are within
+    # the allowed ranges, widened by the smallest number of "step" (i.e. each
+    # "min" is decreased and each "max" increased by i*step) which leaves at
+    # least n_min valid rows. The number of steps needed by each row is
+    # computed directly, so that the widening is the n_min-th smallest of them
+
+    n_rows = len(hdulist['posterior pdf'].data)
+    n_steps = np.zeros(n_rows)
+
+    columns = OrderedDict()
+    for key, value in params_ranges.iteritems():
+        data = hdulist[value["extName"]].data[value["colName"]]
+        columns[key] = data
+
+        if "step" in value:
+            step = value["step"]
+        else:
+            step = 0
+
+        for limit, sign in (("min", 1.), ("max", -1.)):
+            if limit not in value:
+                continue
+            # Distance (in the direction of the widening) between the limit and
+            # the parameter, NaN never being excluded as in the comparisons below
+            distance = sign * (value[limit]-data)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if step > 0:
+                    n = np.ceil(distance / step)
+                else:
+                    n = np.where(distance > 0., np.inf, 0.)
+            n_steps = np.fmax(n_steps, n)
+
+    if n_min > n_rows:
+        raise ValueError('Only '+str(n_rows)+' rows available, while '+str(n_min)+' are required!')
+
+    i = max(0., np.partition(n_steps, n_min-1)[n_min-1]) if n_min > 0 else 0.
+    if not np.isfinite(i):
+        raise ValueError('The parameter ranges cannot be widened to contain '+str(n_min)+' rows!')
+
+    def get_mask(i):
+        mask = np.ones(n_rows, dtype=bool)
+        for key, value in params_ranges.iteritems():
+            data = columns[key]
+            step = value.get("step", 0)
+            with np.errstate(invalid='ignore'):
+                if "min" in value:
+                    mask[data < value["min"]-i*step] = False
+                if "max" in value:
+                    mask[data > value["max"]+i*step] = False
+        return mask
+
+    # Check the widening with the same comparisons used to build the mask,
+    # correcting for the rounding errors of the number of steps
+    i = int(i)
+    mask = get_mask(i)
+    while np.sum(mask) < n_min:
+        i += 1
+        mask = get_mask(i)
+    while i > 0:
+        _mask = get_mask(i-1)
+        if np.sum(_mask) < n_min:
+            break
+        i -= 1
+        mask = _mask
+
+    return mask
 
 # ****************************************************************************************
 def draw_rows_from_interval(data, probability, n_draws=1, level=0.68):
@@ -87,19 +175,47 @@ def draw_rows_from_interval(data, probability, n_draws=1, level=0.68):
     CredInterv = CredibleInterval(data=data, probability=probability)
     indices = np.arange(len(probability))
 
-    if data.ndim == 1:
-        region = CredInterv.Get1DCredibleRegion(levels=(level,))
-        ok = np.where((data >= region[0]) & (data <= region[1]))[0] 
-    elif data.ndim == 2:
-        prob_level = CredInterv.GetProbabilityFor2DCredibleRegion(levels=(level,))
-        kde_pdf_grid =  CredInterv.kde_pdf(data)
-        ok = np.where((kde_pdf_grid >= prob_level))[0]
+    # In 2D the density at the samples is interpolated on the grid of the
+    # KDE, rather than evaluating the KDE at each sample
+    ok = np.where(CredInterv.GetSamplesInCredibleRegion(level))[0]
 
     return np.random.choice(indices[ok], size=n_draws)
 
 
+# Cosmology used by Speagle et al. (2014) to compute the age of the Universe,
+# (h,omega_m,omega_lambda) = (0.7,0.3,0.7)
+cosmology = FlatLambdaCDM(H0=70, Om0=0.3)
+
+_age_grid = None
+
 # ****************************************************************************************
-def mass_logOH_sfr(mass, SFR, logOH, scatter='t-Student', df=3, scale=0.3):
+def get_cosmic_age(redshift, z_max=50., n_grid=2000):
+    # Age of the Universe (Gyr), interpolated on a grid of log(1+z) computed
+    # only once, rather than integrated for each posterior sample
+    global _age_grid
+
+    if _age_grid is None:
+        x = np.linspace(0., np.log1p(z_max), n_grid)
+        _age_grid = (x, cosmology.age(np.expm1(x)).value)
+
+    return np.interp(np.log1p(redshift), _age_grid[0], _age_grid[1])
+
+# ****************************************************************************************
+def scatter_logpdf(x, mean, scatter='t-Student', df=3, scale=0.3):
+    # Log of the PDF of the scatter of a quantity around the mean relation,
+    # computed at once for all the posterior samples
+
+    if scatter.lower() == 't-student':
+        return stats.t.logpdf(x, df=df, loc=mean, scale=scale)
+    elif scatter.lower() == 'gaussian':
+        return stats.norm.logpdf(x, loc=mean, scale=scale)
+    elif scatter.lower() == 'cauchy':
+        return stats.cauchy.logpdf(x, loc=mean, scale=scale)
+    else:
+        raise ValueError('The input scatter '+scatter+' is not supported!')
+
+# ****************************************************************************************
+def mannucci10(mass, SFR, logOH):
     # From Mannucci et al. (2010), followng our implementation in Williams et
     # al (2018), sec 3.4.3 (equations 15-17)
 
@@ -108,19 +224,10 @@ def mass_logOH_sfr(mass, SFR, logOH, scatter='t-Student', df=3, scale=0.3):
 
     mean_logOH = -0.14*logSFR + 0.37*logM + 4.82 # In units of 12 + log(O/H)
 
-    pdf = np.zeros(len(logM))
-
-    for i in range(len(logOH)):
-
-        if scatter.lower() == 't-student':
-            pdf[i] = stats.t.pdf(logOH[i], df=df, loc=mean_logOH[i], scale=scale)
-        else:
-            raise ValueError('The input scatter '+scatter+' is not supported!')
-
-    return pdf
+    return logOH, mean_logOH
 
 # ****************************************************************************************
-def metallicity_logU(metallicity, logU, scatter='t-Student', df=3, scale=0.3):
+def carton17(metallicity, logU):
     # From Carton et al. (2017), followng our implementation in Williams et
     # al (2018), sec 3.4.3 (equation 18)
     
@@ -128,19 +235,10 @@ def metallicity_logU(metallicity, logU, scatter='t-Student', df=3, scale=0.3):
     logZ = np.log10(metallicity/Z_sun)
     mean_logU = -0.8 * logZ -3.58  # metallicity expressed in log(Z/Z_sun)
 
-    pdf = np.zeros(len(logZ))
-
-    for i in range(len(logU)):
-
-        if scatter.lower() == 't-student':
-            pdf[i] = stats.t.pdf(logU[i], df=df, loc=mean_logU[i], scale=scale)
-        else:
-            raise ValueError('The input scatter '+scatter+' is not supported!')
-
-    return pdf
+    return logU, mean_logU
 
 # ****************************************************************************************
-def mass_sfr(mass, SFR, redshift, scatter='t-Student', df=3, scale=0.3):
+def speagle14(mass, SFR, redshift):
     #Speagle+ 14 - log(M*) = (0.84-0.026*t)logM - (6.51-0.11*t)
     #cosmology used in paper to calculate ages (t) is (h,omega_m,omega_lambda) = (0.7,0.3,0.7)
     #Shivaei+ 15 measure scatter in log(SFR(Halpha))-log(M*) to be 0.3 dex (corrected for uncertainties)
@@ -148,24 +246,61 @@ def mass_sfr(mass, SFR, redshift, scatter='t-Student', df=3, scale=0.3):
     logM = np.log10(mass)
     logSFR = np.log10(SFR)
 
-    cosmo = FlatLambdaCDM(H0=70, Om0=0.3)
-    t = cosmo.age(redshift).value
+    t = get_cosmic_age(redshift)
     mean_SFR = (0.84-0.026*t)*logM - (6.51-0.11*t)
 
-    pdf = np.zeros(len(logM))
+    return logSFR, mean_SFR
 
-    for i in range(len(logSFR)):
+# Relations that can be used in the JSON file of the prior weights, each
+# returning the quantity and its mean value predicted by the relation
+prior_relations = {
+        "speagle14": speagle14,
+        "mannucci10": mannucci10,
+        "carton17": carton17
+        }
 
-        if scatter.lower() == 't-student':
-            pdf[i] = stats.t.pdf(logSFR[i], df=df, loc=mean_SFR[i], scale=scale)
-        elif scatter.lower() == 'gaussian':
-            pdf[i] = stats.norm.pdf(logSFR[i], loc=mean_SFR[i], scale=0.3)
-        elif scatter.lower() == 'cauchy':
-            pdf[i] = stats.cauchy.pdf(logSFR[i], loc=mean_SFR[i], scale=0.3)
-        else:
-            raise ValueError('The input scatter '+scatter+' is not supported!')
+# ****************************************************************************************
+def mass_logOH_sfr(mass, SFR, logOH, scatter='t-Student', df=3, scale=0.3):
+
+    return np.exp(scatter_logpdf(*mannucci10(mass, SFR, logOH), scatter=scatter, df=df, scale=scale))
+
+# ****************************************************************************************
+def metallicity_logU(metallicity, logU, scatter='t-Student', df=3, scale=0.3):
+
+    return np.exp(scatter_logpdf(*carton17(metallicity, logU), scatter=scatter, df=df, scale=scale))
+
+# ****************************************************************************************
+def mass_sfr(mass, SFR, redshift, scatter='t-Student', df=3, scale=0.3):
 
-    return pdf
+    return np.exp(scatter_logpdf(*speagle14(mass, SFR, redshift), scatter=scatter, df=df, scale=scale))
+
+# ****************************************************************************************
+def get_log_weights(hdulist, priors):
+    # Sum of the log of the weights of the posterior samples of a Beagle
+    # output file, for the priors of a JSON configuration of the form
+    #   {"mass_SFR": {"relation": "speagle14", "scatter": "t-Student", "df": 3,
+    #       "scale": 0.3, "variables": {"mass": {"colName": "M_star", "extName":
+    #       "galaxy properties"}, ...}}, ...}
+    # where "variables" maps the arguments of the relation to the Beagle columns
+
+    log_weights = np.zeros(len(hdulist['posterior pdf'].data))
+
+    for key, value in priors.iteritems():
+        if value["relation"] not in prior_relations:
+            raise ValueError('The relation '+value["relation"]+' of the prior '+key+' is not supported!')
+
+        func_args = OrderedDict()
+        for _key, _value in value['variables'].iteritems():
+            func_args[_key] = hdulist[_value["extName"]].data[_value["colName"]]
+
+        x, mean = prior_relations[value["relation"]](**func_args)
+
+        log_weights += scatter_logpdf(x, mean, 
+                scatter=value.get("scatter", "t-Student"), 
+                df=value.get("df", 3), 
+                scale=value.get("scale", 0.3))
+
+    return log_weights
 
 # ########################################################################################
 # ########################################################################################
@@ -295,7 +430,8 @@ def draw_rows_from_posterior(ID, fileName,
         weight_func=None, 
         UVJ_data=None,
         extensions=None,
-        make_plot=False):
+        make_plot=False,
+        UVJ_cuts=None):
 
     print "Extracting rows from object ID: ", ID, "(filename: ", fileName, ")"
 
@@ -308,8 +444,6 @@ def draw_rows_from_posterior(ID, fileName,
     # Photometric redshifts computed by Beagle
     redshifts = hdulist['galaxy properties'].data['redshift']
 
-    weights = np.full(1, len(post), dtype=np.float32)
-
     # Compute the posterior median for the photometric redshift
     CredInterv_redshfit = CredibleInterval(data=redshifts, probability=post)
     median_redshift = CredInterv_redshfit.GetMedian()
@@ -325,9 +459,15 @@ def draw_rows_from_posterior(ID, fileName,
         U_V_color = UVJ_bands['U']-UVJ_bands['V']
         V_J_color = UVJ_bands['V']-UVJ_bands['J']
 
-        data = np.zeros((2,len(post)))
+        # Any other quantity in the UVJ dictionary (e.g. the redshift) is
+        # added to the colours to draw from their joint credible region
+        extra = [key for key in UVJ_bands if key not in ('U', 'V', 'J')]
+
+        data = np.zeros((2+len(extra),len(post)))
         data[0,:] = U_V_color
         data[1,:] = V_J_color
+        for i, key in enumerate(extra):
+            data[2+i,:] = UVJ_bands[key]
 
         rows = draw_rows_from_interval(data=data, probability=post, n_draws=n_samples, level=0.68)
 
@@ -351,9 +491,10 @@ def draw_rows_from_posterior(ID, fileName,
 
             plt.show()
 
-        for i, row in enumerate(rows):
-            if UVJ_separation(redshifts[row], U_V_color[row], V_J_color[row]) == 1:
-                galaxy_types[i] = 1
+        # Classification of all the posterior samples
+        UVJ_types = UVJ_classification(redshifts, U_V_color, V_J_color, cuts=UVJ_cuts)
+
+        galaxy_types[UVJ_types[rows] == 1] = 1
                 
 
     quiescent_indices = np.where(galaxy_types==1)[0]
@@ -368,73 +509,43 @@ def draw_rows_from_posterior(ID, fileName,
         rows_indices[quiescent_indices] = rows[quiescent_indices]
 
     if n_star_forming > 0:
-        reweighted_pdf = post
+        with np.errstate(divide='ignore'):
+            log_pdf = np.log(post)
 
-        # Can pass a "weight_func" that will take as input some parameters of the
-        # Beagle output and compute a weight, that will be used to multiply the
-        # posterior PDF
+        # Can pass a "weight_func", i.e. a JSON configuration of the priors
+        # (see `get_log_weights`) whose weights multiply the posterior PDF.
+        # The weights are combined in log space, to avoid underflows
         if weight_func is not None:
-            # Cycle over the different weight functions
-            for key, value in weight_func.iteritems():
-                func_args = OrderedDict()
-                # Load the data from the Beagle FITS file into a dictionary
-                for _key, _value in value['variables'].iteritems():
-                    data = hdulist[_value["extName"]].data[_value["colName"]]
-                    func_args[_key] = data
-
-                # Assume that the other entries of the dictionary correspond to kwargs of the weight_func
-                for _key, _value in value.iteritems():
-                    if 'variables' not in _key and 'function' not in _key:
-                        func_args[_key] = _value
-        
-                # Compute the actual weights
-                weights = value['function'](**func_args)
-
-                # Multiply the posterior PDF by the weights
-                reweighted_pdf *= weights
-        #reweighted_pdf = weights
-        #reweighted_pdf = post
+            log_pdf = log_pdf + get_log_weights(hdulist, weight_func)
 
         # Besides the weight function, the user can select some allowed ranges for some parameters
         mask = np.ones(len(post), dtype=bool)
-        n = -1
         if params_ranges is not None:
-            i=0
-            while n < 2*n_samples:
-                mask = np.ones(len(post), dtype=np.bool)
-                for key, value in params_ranges.iteritems():
-                    data = hdulist[value["extName"]].data[value["colName"]]
-                    # The "step" is used to widen the range at each iteration, in
-                    # order to have enough valid elements to then randomly draw
-                    # n_samples from them
-                    if "step" in value:
-                        step = value["step"]
-                    else:
-                        step = 0
-                    if "min" in value:
-                        m = value["min"]-i*step
-                        indx = np.where(data < m)[0]
-                        if len(indx) > 0:
-                            mask[indx] = False
-                    if "max" in value:
-                        m = value["max"]+i*step
-                        indx = np.where(data > m)[0]
-                        if len(indx) > 0:
-                            mask[indx] = False
-
-                n = np.sum(mask)
-                i += 1
+            mask = get_params_ranges_mask(hdulist, params_ranges, 2*n_samples)
 
         #
         if UVJ_data is not None:
-            for i, (redshift, UV, VJ) in enumerate(zip(redshifts, U_V_color, V_J_color)):
-                if UVJ_separation(redshift, UV, VJ) == 1:
-                    mask[i] = False
+            mask[UVJ_types == 1] = False
         
             
         indices = np.arange(len(post))
 
+        # All the allowed rows may have zero weight, e.g. if the priors
+        # exclude the whole posterior: there is then nothing to draw from
+        log_w = log_pdf[mask]
+        log_w = log_w[~np.isnan(log_w)]
+        max_log_w = np.max(log_w) if len(log_w) > 0 else -np.inf
+        if not np.isfinite(max_log_w):
+            msg = "All the allowed rows of object ID " + str(ID) + " have zero weight"
+            if weight_func is not None:
+                msg += " after applying the priors " + ", ".join([key + " (relation " + value["relation"] + ")" 
+                    for key, value in weight_func.iteritems()]) + " of the prior file (`--prior-file`)"
+            raise ValueError(msg)
+
         # Randomly draw the indices of the rows, using as weights the reweighted posterior PDF 
+        with np.errstate(invalid='ignore'):
+            reweighted_pdf = np.exp(log_pdf - max_log_w)
+        reweighted_pdf[~np.isfinite(reweighted_pdf)] = 0.
         wrand = WalkerRandomSampling(reweighted_pdf[mask], keys=indices[mask])
         rows_indices[star_forming_indices] = wrand.random(n_star_forming)
 
@@ -507,6 +618,23 @@ if __name__ == '__main__':
         action='store_true'
         )
 
+    parser.add_argument(
+        '--UVJ-redshift', 
+        help="Draw the rows from the joint (U-V, V-J, redshift) credible region, rather than from the \
+                (U-V, V-J) one.",
+        dest='UVJ_redshift', 
+        action='store_true'
+        )
+
+    parser.add_argument(
+        '--UVJ-cuts', 
+        help="JSON file containing the redshift-binned UVJ colour cuts (by default the Whitaker+ 11 ones).",
+        action="store", 
+        type=str, 
+        dest="UVJ_cuts",
+        default=UVJ_cuts_file
+        )
+
     parser.add_argument(
         '--UVJ-columns', 
         help="Name of the columns in the Beagle output FITS file containing the UVJ magnitudes.",
@@ -571,6 +699,16 @@ if __name__ == '__main__':
         dest="params_ranges"
     )
 
+    parser.add_argument(
+        '--prior-file',
+        help="JSON file containing the relations (mass-SFR, mass-metallicity-SFR, metallicity-logU) \
+                used to reweight the posterior PDF",
+        action="store", 
+        type=str, 
+        dest="prior_file",
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "prior_weights_config.json")
+    )
+
     parser.add_argument(
         '--plot', 
         dest='plot', 
@@ -617,42 +755,10 @@ if __name__ == '__main__':
     if args.n_objects < 0:
         args.n_objects = len(IDs)
 
-    # Arguments used by the "weight function", which is multiplied by the
-    # posterior pdf to then select solutions from all the possible ones which
-    # are output from Beagle
-    weight_func = OrderedDict()
-
-    # Mass-SFR relation
-    weight_func['mass_SFR']= OrderedDict()
-    weight_func['mass_SFR']['function'] = mass_sfr
-    weight_func['mass_SFR']['scatter'] = 't-Student'
-    weight_func['mass_SFR']['scale'] = 0.3
-    weight_func['mass_SFR']['variables'] = {
-            'mass' : {"colName":"M_star", "extName":"galaxy properties"},
-            'SFR' : {"colName":"SFR", "extName":"star formation"},
-            'redshift' : {"colName":"redshift", "extName":"galaxy properties"}
-            }
-
-    # Mass-metallicity-SFR relation
-    weight_func['mass_logOH_sfr']= OrderedDict()
-    weight_func['mass_logOH_sfr']['function'] = mass_logOH_sfr
-    weight_func['mass_logOH_sfr']['scatter'] = 't-Student'
-    weight_func['mass_logOH_sfr']['scale'] = 0.2
-    weight_func['mass_logOH_sfr']['variables'] = {
-            'mass' : {"colName":"M_star", "extName":"galaxy properties"},
-            'SFR' : {"colName":"sfr", "extName":"star formation"},
-            'logOH' : {"colName":"logOH", "extName":"nebular emission"}
-            }
-
-    # Metallicity-logU relation
-    weight_func['metallicity_logU']= OrderedDict()
-    weight_func['metallicity_logU']['function'] = metallicity_logU
-    weight_func['metallicity_logU']['scatter'] = 't-Student'
-    weight_func['metallicity_logU']['scale'] = 0.2
-    weight_func['metallicity_logU']['variables'] = {
-            'metallicity' : {"colName":"Z_ISM", "extName":"nebular emission"},
-            'logU' : {"colName":"logU", "extName":"nebular emission"}
-            }
+    # Priors whose weights are multiplied by the posterior pdf to then select
+    # solutions from all the possible ones which are output from Beagle
+    with open(args.prior_file) as f:
+        weight_func = json.load(f, object_pairs_hook=OrderedDict)
 
     #
     UVJ_data = None
@@ -662,6 +768,11 @@ if __name__ == '__main__':
         for key, col in zip(('U', 'V', 'J'), args.UVJ_columns):
             UVJ_data[key] = {"colName":col, "extName":"absolute magnitudes"}
 
+        if args.UVJ_redshift:
+            UVJ_data['redshift'] = {"colName":"redshift", "extName":"galaxy properties"}
+
+    UVJ_cuts = read_UVJ_cuts(args.UVJ_cuts)
+
     # Restrict the allowed solutions to have some parameters within defined ranges
     params_ranges=None
     if args.params_ranges is not None:
@@ -680,7 +791,8 @@ if __name__ == '__main__':
                     weight_func=weight_func,
                     UVJ_data=UVJ_data,
                     extensions=extensions,
-                    make_plot=make_plot
+                    make_plot=make_plot,
+                    UVJ_cuts=UVJ_cuts
                     )
             results.append(res)
     else:
@@ -694,7 +806,9 @@ if __name__ == '__main__':
                 (params_ranges,)*len(IDs),
                 (weight_func,)*len(IDs),
                 (UVJ_data,)*len(IDs),
-                (extensions,)*len(IDs)
+                (extensions,)*len(IDs),
+                (make_plot,)*len(IDs),
+                (UVJ_cuts,)*len(IDs)
                 )
 
     # Initialize an empty HDU
@@ -0,0 +1,311 @@
+from collections import OrderedDict
+import json
+import numpy as np
+from astropy.io import fits
+from scipy.special import ndtr
+
+# FWHM of the line spread function in units of the wavelength bin, i.e. the
+# `elemsize` used to build the NIRSpec wavelength grid from the resolution
+# curve in p_spectrumMOS1x3_JC.py (delta_lbda = wave / (2.2 * R))
+LSF_pixels = 2.2
+
+# Default width of the redshift bins of `fit_lines`, in units of the
+# smallest pixel size in log(wavelength), i.e. redshift_step = 0.25 *
+# min(dwl/wl). The templates are then offset by at most 1/8 of a pixel,
+# which biases the fitted fluxes by at most ~0.4%. Wider bins batch more
+# objects in each matrix product, but the worst-case bias grows quickly:
+# ~1.7%, ~7% and ~24% for bins of 0.5, 1 and 2 pixels (Gaussian line
+# spread function of FWHM 2.2 pixels)
+redshift_step_pixels = 0.25
+
+def read_resolution_curve(file_name):
+    """
+    Read a resolution curve, i.e. a FITS table with the columns WAVELENGTH
+    (micron) and R, as the JWST/NIRSpec dispersion files
+
+    Returns
+    -------
+    resolution : tuple
+        Wavelength (Ang) and resolving power R
+    """
+
+    with fits.open(file_name) as hdulist:
+        wl = np.array(hdulist[1].data['WAVELENGTH'], dtype=np.float64) * 1.E+04
+        R = np.array(hdulist[1].data['R'], dtype=np.float64)
+
+    return wl, R
+
+def get_line_FWHM(wl_lines, wl, dwl, resolution=None):
+    """
+    FWHM (Ang) of lines at the observed wavelengths `wl_lines`, either from
+    the resolution curve (wavelength, R) or, if this is not given, from the
+    wavelength grid of the spectrum
+    """
+
+    if resolution is None:
+        return LSF_pixels * np.interp(wl_lines, wl, dwl)
+
+    return wl_lines / np.interp(wl_lines, resolution[0], resolution[1])
+
+def get_line_profiles(wl, minw, maxw, dwl, wl_lines, FWHM=None):
+    """
+    Gaussian profiles of lines of unit flux centred at the observed
+    wavelengths `wl_lines`, integrated over each wavelength bin. If `FWHM`
+    is not given, the lines have the width of the line spread function.
+
+    Returns
+    -------
+    profiles : numpy array
+        2D array of shape (n_lines, n_wl), F_lambda
+    """
+
+    wl_lines = np.reshape(wl_lines, (-1, 1))
+    if FWHM is None:
+        FWHM = get_line_FWHM(wl_lines, wl, dwl)
+    sigma = np.reshape(FWHM, (-1, 1)) / (2.*np.sqrt(2.*np.log(2.)))
+
+    return (ndtr((maxw-wl_lines)/sigma) - ndtr((minw-wl_lines)/sigma)) / dwl
+
+def read_line_components(file_name):
+
+    with open(file_name) as f:
+        components = json.load(f, object_pairs_hook=OrderedDict)
+
+    return components
+
+def get_line_templates(lines, wl_central, components=None):
+    """
+    Rest-frame wavelengths and relative fluxes (normalized to unity) of the
+    components of each line of a JSON configuration, so that blends, such as
+    Halpha_NII, are fitted with a single profile. Lines without entry in
+    `components` (as read by `read_line_components`) have a single component
+    at `wl_central`.
+    """
+
+    templates = list()
+    for key, wl in zip(lines, wl_central):
+        if components is not None and key in components:
+            wls = np.array(components[key]["components"], dtype=np.float64)
+            ratios = np.array(components[key].get("ratios", np.ones(len(wls))), dtype=np.float64)
+        else:
+            wls, ratios = np.array([wl]), np.array([1.])
+        templates.append((wls, ratios/np.sum(ratios)))
+
+    return templates
+
+def get_fit_regions(minw, maxw, redshift, windows, pad_pixels=5):
+    """
+    Pixels covered by the lines, and pixel range used to fit each line,
+    made of the line window and of the continuum windows (or `pad_pixels`
+    on each side where a continuum window is not defined)
+    """
+
+    n_wl = len(minw)
+    z1 = 1.+redshift
+
+    wl_range = windows["wl_range"] * z1
+    covered = (wl_range[:,0] >= minw[0]) & (wl_range[:,1] <= maxw[-1])
+
+    lo, hi = np.copy(wl_range[:,0]), np.copy(wl_range[:,1])
+    pad_left = np.full(len(lo), pad_pixels)
+    pad_right = np.full(len(lo), pad_pixels)
+
+    for key, pad in (("continuum_left", pad_left), ("continuum_right", pad_right)):
+        window = windows[key] * z1
+        with np.errstate(invalid='ignore'):
+            valid = (window[:,0] < window[:,1]) & (window[:,0] >= minw[0]) & (window[:,1] <= maxw[-1])
+        lo = np.where(valid, np.minimum(lo, window[:,0]), lo)
+        hi = np.where(valid, np.maximum(hi, window[:,1]), hi)
+        pad[valid] = 0
+
+    p0 = np.clip(np.searchsorted(maxw, lo, side='right') - pad_left, 0, n_wl-1)
+    p1 = np.clip(np.searchsorted(minw, hi) - 1 + pad_right, 0, n_wl-1)
+
+    return covered, p0, p1
+
+def get_design_matrix(wl, minw, maxw, dwl, redshift, windows, templates, errors,
+        resolution=None, pad_pixels=5):
+    """
+    Design matrix of the linear least-squares fit of the lines at a given
+    redshift, and the corresponding estimator matrix
+
+    The model is made of one Gaussian template per line (the sum of its
+    components, with FWHM given by the resolution curve), plus a straight
+    continuum over each segment of overlapping fit regions, so that lines
+    close to each other (e.g. Hbeta and [OIII]) are fitted simultaneously.
+    The fit is weighted by the reference noise `errors`: for a single line
+    on a known continuum this is the matched filter.
+
+    Returns
+    -------
+    design : OrderedDict
+        "pixels": indices of the pixels entering the fit, "estimator": matrix
+        of shape (n_parameters, n_pixels) giving the parameters when
+        multiplied by the fluxes, "covered": whether each line is fitted,
+        "line": estimator of the flux of each line, "continuum": estimator
+        of the continuum at the centre of each line (F_lambda)
+    """
+
+    n_wl, n_lines = len(wl), len(templates)
+    z1 = 1.+redshift
+
+    covered, p0, p1 = get_fit_regions(minw, maxw, redshift, windows, pad_pixels=pad_pixels)
+    indices = np.flatnonzero(covered)
+
+    # Merge overlapping fit regions into segments sharing the continuum
+    segments = list()
+    for k in indices[np.argsort(p0[indices], kind='mergesort')]:
+        if segments and p0[k] <= segments[-1][1]+1:
+            segments[-1][1] = max(segments[-1][1], p1[k])
+            segments[-1][2].append(k)
+        else:
+            segments.append([p0[k], p1[k], [k]])
+
+    n_parameters = len(indices) + 2*len(segments)
+    matrix = np.zeros((n_wl, n_parameters))
+    used = np.zeros(n_wl, dtype=bool)
+
+    column = dict()
+    for j, k in enumerate(indices):
+        wls, ratios = templates[k]
+        wls = wls * z1
+        profiles = get_line_profiles(wl, minw, maxw, dwl, wls,
+                FWHM=get_line_FWHM(wls, wl, dwl, resolution=resolution))
+        matrix[:,j] = np.dot(ratios, profiles)
+        column[k] = j
+
+    # Continuum of each segment, a + b*x with x in [-1/2, 1/2] over the segment
+    centre = dict()
+    for s, (i0, i1, members) in enumerate(segments):
+        j = len(indices) + 2*s
+        wl_mid, width = 0.5*(wl[i0]+wl[i1]), max(wl[i1]-wl[i0], dwl[i0])
+        matrix[i0:i1+1,j] = 1.
+        matrix[i0:i1+1,j+1] = (wl[i0:i1+1]-wl_mid) / width
+        used[i0:i1+1] = True
+        for k in members:
+            centre[k] = (j, (windows["wl_central"][k]*z1-wl_mid) / width)
+
+    pixels = np.flatnonzero(used)
+    A = matrix[pixels,:]
+
+    # Weighted pseudo-inverse, robust to (nearly) degenerate templates
+    with np.errstate(divide='ignore'):
+        weights = np.where(errors[pixels] > 0., 1./errors[pixels], 0.)
+    estimator = np.linalg.pinv(A * weights[:,np.newaxis]) * weights[np.newaxis,:]
+
+    design = OrderedDict()
+    design["pixels"] = pixels
+    design["estimator"] = estimator
+    design["covered"] = covered
+    design["line"] = np.zeros((n_lines, len(pixels)))
+    design["continuum"] = np.zeros((n_lines, len(pixels)))
+    for k in indices:
+        j, x = centre[k]
+        design["line"][k,:] = estimator[column[k],:]
+        design["continuum"][k,:] = estimator[j,:] + x*estimator[j+1,:]
+
+    return design
+
+def fit_lines(wl, minw, maxw, dwl, fluxes, errors, redshift, windows, templates,
+        resolution=None, redshift_step=None, pad_pixels=5):
+    """
+    Fit the lines of a spectrum (or of a cube of spectra sharing the same
+    wavelength grid) by linear least squares of Gaussian templates
+
+    The spectra are grouped in bins of log(1+z) of width `redshift_step`:
+    the design matrix is built once per bin, at the redshift of the bin
+    centre, and all the spectra of the bin are fitted with one matrix
+    product, propagating the noise of each spectrum to the fluxes. The line
+    templates of a spectrum are therefore shifted by at most
+    redshift_step/2 in log(wavelength), i.e. by at most
+    (redshift_step/2) / min(dwl/wl) pixels. By default the step is a
+    quarter of the smallest pixel size in log(wavelength), min(dwl/wl)/4,
+    so that the templates are offset by at most 1/8 of a pixel whatever
+    the resolution of the grating. The price is that, for objects with
+    continuous redshifts, most bins contain a single object, so that the
+    spectra are fitted with one matrix product per bin only across the
+    noise realizations (or objects) sharing a redshift; a larger
+    `redshift_step` batches more objects at the cost of a larger bias on
+    the fluxes (see `redshift_step_pixels`). The rest-frame EW uses the
+    redshift of each object.
+
+    Parameters
+    ----------
+    wl, minw, maxw, dwl : numpy arrays
+        Central, minimum, maximum wavelength and width of each pixel (Ang)
+
+    fluxes, errors : numpy arrays
+        Flux and flux error (F_lambda), either 1D or 2D (n_objects x n_wl)
+
+    redshift : float or numpy array
+        Redshift of the spectrum, or of each object of the cube
+
+    windows : dict
+        Rest-frame windows of the lines, as returned by `get_line_windows`
+
+    templates : list
+        Components of each line, as returned by `get_line_templates`
+
+    resolution : tuple, optional
+        Resolution curve (wavelength, R), as returned by `read_resolution_curve`
+
+    redshift_step : float, optional
+        Width of the bins in log(1+z), by default redshift_step_pixels *
+        min(dwl/wl) = min(dwl/wl)/4
+
+    Returns
+    -------
+    measurements : OrderedDict
+        Same quantities as `measure_lines` in compute_emission_line_SN.py
+        ("flux", "flux_err", "continuum", "EW", "SN"), with shape (n_lines,)
+        or (n_objects, n_lines), and -99.99 for lines that are not measured
+    """
+
+    cube = np.ndim(fluxes) == 2
+    fluxes = np.atleast_2d(fluxes)
+    errors = np.atleast_2d(errors)
+    n_objects, n_lines = fluxes.shape[0], len(templates)
+    redshift = np.broadcast_to(redshift, (n_objects,))
+
+    measurements = OrderedDict()
+    for key in ("flux", "flux_err", "continuum", "EW", "SN"):
+        measurements[key] = np.full((n_objects, n_lines), -99.99)
+
+    if redshift_step is None:
+        redshift_step = redshift_step_pixels * np.amin(dwl/wl)
+
+    bins = np.round(np.log1p(redshift) / redshift_step).astype(int)
+    for b in np.unique(bins):
+        objects = np.flatnonzero(bins == b)
+        z = np.expm1(b * redshift_step)
+
+        # Reference noise of the bin, used to weight the fit
+        design = get_design_matrix(wl, minw, maxw, dwl, z, windows, templates,
+                np.median(errors[objects,:], axis=0), resolution=resolution,
+                pad_pixels=pad_pixels)
+
+        pixels = design["pixels"]
+        F = fluxes[np.ix_(objects, pixels)]
+        V = errors[np.ix_(objects, pixels)]**2
+
+        flux = np.dot(F, design["line"].T)
+        flux_err = np.sqrt(np.dot(V, (design["line"]**2).T))
+        continuum = np.dot(F, design["continuum"].T)
+
+        covered = design["covered"][np.newaxis,:]
+        z1 = 1.+redshift[objects,np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            EW = flux / continuum / z1
+            SN = flux / flux_err
+
+        measurements["flux"][objects,:] = np.where(covered, flux, -99.99)
+        measurements["flux_err"][objects,:] = np.where(covered, flux_err, -99.99)
+        measurements["continuum"][objects,:] = np.where(covered, continuum, -99.99)
+        measurements["EW"][objects,:] = np.where(covered & (continuum > 0.), EW, -99.99)
+        measurements["SN"][objects,:] = np.where(covered & (flux > 0.), SN, -99.99)
+
+    if not cube:
+        for key, value in measurements.iteritems():
+            measurements[key] = value[0,:]
+
+    return measurements
@@ -23,6 +23,8 @@ import beagle_multiprocess
 
 from pathos.multiprocessing import ProcessingPool 
 
+from simulations_index import get_simulations_index
+
 c_light = 2.99792e+18 # Ang/s
 show_plot = False
 
@@ -157,6 +159,9 @@ def make_ETC_simulations_single(ETC_simulation_prefix,
         # (in Jansky)
         write_ETC_input_file(wl, sed, redshift, ETC_input_file)
 
+    # List of (output file, number of exposures), used to update the index of the simulations
+    ETC_output_files = list()
+
     # Cycle across each combination of filter, grating, and number of exposures
     for FWA, GWA, nbexp in zip(args.FWAs, args.GWAs, args.nbexps):
 
@@ -205,6 +210,11 @@ def make_ETC_simulations_single(ETC_simulation_prefix,
 
             hduETC.close()
 
+        if os.path.isfile(ETC_output_file):
+            ETC_output_files.append((ETC_output_file, nbexp))
+
+    return ETC_output_files
+
 def Shibuya_sizes(redshift, L_UV):
 
     # See Williams et al 2018, Sec 5.2 (equation 28)
@@ -445,8 +455,9 @@ if __name__ == '__main__':
     # If the user does not specify the number of processors to be used, assume that it is a serial job
     if args.nproc <= 0:
 
+        results = list()
         for i in range(len(rows)):
-             make_ETC_simulations_single(
+             res = make_ETC_simulations_single(
                 ETC_simulation_prefix=ETC_simulation_prefixes[i],
                 wl=wl,
                 sed=SEDs[i],
@@ -459,6 +470,7 @@ if __name__ == '__main__':
                 effective_radius=r_eff[i],
                 seed=args.seed
                 )
+             results.append(res)
     
     # Otherwise you use pathos to run in parallel on multiple CPUs
     else:
@@ -467,7 +479,7 @@ if __name__ == '__main__':
         pool = ProcessingPool(nodes=args.nproc)
 
         # Launch the actual calculation on multiple processesors
-        pool.map(make_ETC_simulations_single, 
+        results = pool.map(make_ETC_simulations_single, 
             ETC_simulation_prefixes,
             (wl,)*len(rows),
             SEDs,
@@ -480,3 +492,14 @@ if __name__ == '__main__':
             r_eff,
             (args.seed,)*len(rows)
             )
+
+    # Update the index of the simulated spectra (only done here, and not by
+    # the parallel processes, to avoid concurrent writes). The index is built
+    # from the folder content first if missing (e.g. previous runs without
+    # the index), or updated if it does not match the folder content, so
+    # that it also contains the spectra of previous runs
+    index = get_simulations_index(ETC_output_dir, update=True)
+    for ETC_output_files in results:
+        for ETC_output_file, nbexp in ETC_output_files:
+            index.add(ETC_output_file, nexp=nbexp)
+    index.save()
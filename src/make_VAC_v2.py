@@ -1,10 +1,10 @@
 from collections import OrderedDict
-from scipy.interpolate import interp1d
 from astropy.io import fits
 import os
 import numpy as np
 from astropy.table import Table, Column
 from make_value_added_catalogue import extract_data, get_mode_rows
+from credible_intervals import get_credible_intervals
 
 def get1DInterval(param_values, probability, levels):
 
@@ -39,23 +39,15 @@ def get1DInterval(param_values, probability, levels):
 
     """
 
-    sort_ = np.argsort(param_values)
-    cumul_pdf = np.cumsum(probability[sort_])
-    cumul_pdf /= cumul_pdf[len(cumul_pdf)-1]
+    intervals = get_credible_intervals(param_values, probability, levels=levels)
 
-    # Get the interpolant of the cumulative probability
-    f_interp = interp1d(cumul_pdf, param_values[sort_])
+    mean = intervals["mean"]
 
-    #
-    mean = np.sum(probability * param_values) / np.sum(probability)
-
-    median = f_interp(0.5)
+    median = intervals["median"]
 
     interval = list()
     for lev in levels:
-
-        low, high = f_interp([0.5*(1.-lev/100.), 1.-0.5*(1.-lev/100.)])
-        interval.append([low,high])
+        interval.append(list(intervals["regions"][str(lev)]))
 
     return mean, median, interval
 
@@ -11,7 +11,6 @@ import argparse
 import ConfigParser
 import numpy as np
 from collections import OrderedDict
-from scipy.interpolate import interp1d
 from collections import defaultdict
 import itertools
 import matplotlib.pyplot as plt
@@ -19,6 +18,7 @@ import matplotlib.pyplot as plt
 import sys
 sys.path.append(os.path.join(os.environ['PYP_BEAGLE'], "PyP-BEAGLE"))
 from beagle_utils import BeagleDirectories, extract_IDs
+from credible_intervals import get_credible_intervals, get_derived_credible_intervals, parse_expression
 import beagle_multiprocess
 
 from pathos.multiprocessing import ProcessingPool 
@@ -231,7 +231,7 @@ def extract_data(ID, n_par, redshift_index, redshift_type=None):
 
     return outData
 
-def get1DInterval(ID, param_names, levels=[68., 95.]):
+def get1DInterval(ID, param_names, levels=[68., 95.], expressions=None):
 
     suffix = BeagleDirectories.suffix + '.fits.gz'
 
@@ -240,34 +240,47 @@ def get1DInterval(ID, param_names, levels=[68., 95.]):
         return None
 
     param_values = OrderedDict()
+    columns = dict()
     with fits.open(full_path) as f:
         probability = f['POSTERIOR PDF'].data['probability']
         for name in param_names:
             param_values[name] = f['POSTERIOR PDF'].data[name]
 
-    output = OrderedDict()
-    for key, value in param_values.iteritems():
+        # Columns entering the derived quantities, taken from the first
+        # extension of the Beagle output which contains them
+        if expressions is not None:
+            for expression in expressions.itervalues():
+                for name in parse_expression(expression)[1]:
+                    for hdu in f[1:]:
+                        if isinstance(hdu, fits.BinTableHDU) and name in hdu.columns.names \
+                                and len(hdu.data) == len(probability):
+                            columns[name] = hdu.data[name]
+                            break
 
-        sort_ = np.argsort(value)
+    # All the parameters are processed at once, with one sort per parameter
+    values = np.column_stack(param_values.values())
+    intervals = get_credible_intervals(values, probability, levels=levels)
 
-        cumul_pdf = np.cumsum(probability[sort_])
-        cumul_pdf /= cumul_pdf[len(cumul_pdf)-1]
+    output = OrderedDict()
+    for i, key in enumerate(param_values):
 
-        # Get the interpolant of the cumulative probability
-        f_interp = interp1d(cumul_pdf, value[sort_])
+        interval = OrderedDict()
+        for lev in levels:
+            interval[str(lev)] = intervals["regions"][str(lev)][i,:]
 
-        # You shoud integrate rather than summing here
-        mean = np.sum(probability * value) / np.sum(probability)
+        output[key] = {'mean':intervals["mean"][i], 'median':intervals["median"][i], 'regions':interval}
 
-        median = f_interp(0.5)
+    # Derived quantities are evaluated chunk by chunk from the columns
+    if expressions is not None:
+        intervals = get_derived_credible_intervals(expressions.values(), columns, probability, levels=levels)
 
-        interval = OrderedDict()
-        for lev in levels:
+        for i, key in enumerate(expressions):
 
-            low, high = f_interp([0.5*(1.-lev/100.), 1.-0.5*(1.-lev/100.)])
-            interval[str(lev)] = np.array([low,high])
+            interval = OrderedDict()
+            for lev in levels:
+                interval[str(lev)] = intervals["regions"][str(lev)][i,:]
 
-        output[key] = {'mean':mean, 'median':median, 'regions':interval}
+            output[key] = {'mean':intervals["mean"][i], 'median':intervals["median"][i], 'regions':interval}
 
     return output
 
@@ -340,6 +353,17 @@ if __name__ == '__main__':
         dest="credible_regions"
     )
 
+    parser.add_argument(
+        '--derived',
+        help="Derived quantities for which the credible regions are calculated, in the form \
+                name=expression, where the expression contains columns of the Beagle output \
+                file, e.g. sSFR=\"log10(SFR/M_star)\"",
+        action="store", 
+        type=str, 
+        nargs='+',
+        dest="derived"
+    )
+
 
     # Get parsed arguments
     args = parser.parse_args()
@@ -399,6 +423,14 @@ if __name__ == '__main__':
     # Columns to be added to the catalogues
     param_names = ["redshift", "mass"]
 
+    # Derived quantities, only used for the credible regions
+    expressions = None
+    if args.derived is not None:
+        expressions = OrderedDict()
+        for derived in args.derived:
+            name, expression = derived.split('=', 1)
+            expressions[name.strip()] = expression
+
     dictKeys = OrderedDict()
 
     dictKeys["ID_input"] = {"type":"S15", "format":"s"}
@@ -420,6 +452,14 @@ if __name__ == '__main__':
                 dictKeys[key] = {"type":np.float32, "format":".3f"}
                 key = name + "_" + str(region) + "_up"
                 dictKeys[key] = {"type":np.float32, "format":".3f"}
+
+    if args.credible_regions is not None and expressions is not None:
+        for name in expressions:
+            for region in args.credible_regions:
+                key = name + "_" + str(region) + "_low"
+                dictKeys[key] = {"type":np.float32, "format":".3f"}
+                key = name + "_" + str(region) + "_up"
+                dictKeys[key] = {"type":np.float32, "format":".3f"}
     
     paramDict = OrderedDict()
     # Determine number of free parameters by counting columns in Beagle output file
@@ -490,7 +530,8 @@ if __name__ == '__main__':
             if args.credible_regions is not None:
                 c = get1DInterval(ID, 
                         param_names=param_names, 
-                        levels=args.credible_regions
+                        levels=args.credible_regions,
+                        expressions=expressions
                         )
 
                 data_cred_region.append(c)
@@ -512,7 +553,8 @@ if __name__ == '__main__':
             data_cred_region = pool.map(get1DInterval,
                     Beagle_IDs[match_ok],
                     (param_names,)*n_ok,
-                    (args.credible_regions,)*n_ok
+                    (args.credible_regions,)*n_ok,
+                    (expressions,)*n_ok
                     )
 
     for i, indx in enumerate(input_idx):
@@ -550,7 +592,7 @@ if __name__ == '__main__':
         if args.credible_regions is not None:
             c = data_cred_region[i]
             if c is not None:
-                for name in param_names:
+                for name in c:
                     for region in args.credible_regions:
                         key = name + "_" + str(region) + "_low"
                         newCols[key][indx] = c[name]["regions"][str(region)][0]
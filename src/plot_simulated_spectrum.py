@@ -8,6 +8,8 @@ import argparse
 
 import autoscale as autoscale
 
+from simulations_index import get_simulations_index
+
 c_light = 2.99792e+18 # Ang/s
 
 if __name__ == '__main__':
@@ -103,9 +105,12 @@ if __name__ == '__main__':
 
     #hdulist.close()
 
-    # Load the simulated spectrum 
-    file_name = os.path.join(args.folder, "MC_" + args.MC_draw, "ETC-simulations", "ETC-output", 
-            args.ID + "_MC_" + args.MC_draw + "_snr_PS_CLEAR_PRISM.fits")
+    # Load the simulated spectrum, looking it up in the index of the simulations
+    ETC_output_dir = os.path.join(args.folder, "MC_" + args.MC_draw, "ETC-simulations", "ETC-output")
+    file_name = get_simulations_index(ETC_output_dir).lookup(args.ID, MC_draw=args.MC_draw, 
+            FWA="CLEAR", GWA="PRISM")
+    if file_name is None:
+        raise ValueError("Simulated spectrum of object " + args.ID + " not found in " + ETC_output_dir)
 
     hdulist = fits.open(file_name)
     wl_simul = hdulist[1].data['WAVELENGTH'] * 1.E+06
@@ -186,7 +191,7 @@ if __name__ == '__main__':
     plt.show()
 
     if args.savefig:
-        name = os.path.join(args.folder, "MC_" + args.MC_draw, "ETC-simulations", "ETC-output",
+        name = os.path.join(ETC_output_dir,
                 args.ID + "_MC_" + args.MC_draw + "_noiseless_snr_PS_CLEAR_PRISM.pdf")
 
         fig.savefig(name, dpi=None, facecolor='w', edgecolor='w',
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import os
+import json
+import argparse
+from collections import OrderedDict
+from natsort import natsorted
+
+# Name of the index file, stored in the ETC-output folder
+index_file_name = "index.json"
+
+def parse_file_name(file_name):
+    """
+    Extract ID, Monte Carlo draw, filter and grating from the name of a
+    simulated spectrum, i.e. <ID>[_MC_<draw>]_snr_PS_<FWA>_<GWA>.fits
+    """
+
+    s = os.path.splitext(os.path.basename(file_name))[0].split('_')
+
+    MC_draw = None
+    if len(s) > 2 and s[1] == 'MC':
+        MC_draw = s[2]
+
+    return s[0], MC_draw, s[-2], s[-1]
+
+class SimulationsIndex(object):
+    """
+    Persistent index of the simulated spectra contained in an ETC-output
+    folder, mapping (ID, MC draw, FWA, GWA, nexp) to the file name
+    """
+
+    def __init__(self, folder):
+
+        self.folder = folder
+        self.file_name = os.path.join(folder, index_file_name)
+
+        self.entries = OrderedDict()
+        self.configurations = dict()
+
+        if os.path.isfile(self.file_name):
+            self.load()
+
+    def _key(self, ID, MC_draw, FWA, GWA):
+
+        if MC_draw is not None:
+            MC_draw = str(MC_draw)
+
+        return (str(ID), MC_draw, FWA, GWA)
+
+    def add(self, file_name, nexp=None, ID=None, MC_draw=None, FWA=None, GWA=None):
+
+        name = os.path.basename(file_name)
+        _ID, _MC_draw, _FWA, _GWA = parse_file_name(name)
+
+        key = self._key(ID or _ID, MC_draw or _MC_draw, FWA or _FWA, GWA or _GWA)
+        if nexp is not None:
+            nexp = str(nexp)
+            self.entries.pop(key + (None,), None)
+
+        self.entries[key + (nexp,)] = name
+
+        # Lookups without the number of exposures return the last entry added
+        self.configurations[key] = name
+
+    def _lookup(self, ID, MC_draw, FWA, GWA, nexp):
+
+        key = self._key(ID, MC_draw, FWA, GWA)
+        if nexp is None:
+            name = self.configurations.get(key)
+        else:
+            name = self.entries.get(key + (str(nexp),))
+
+        if name is None:
+            return None
+
+        return os.path.join(self.folder, name)
+
+    def lookup(self, ID, MC_draw=None, FWA="CLEAR", GWA="PRISM", nexp=None):
+        """
+        Full path of the simulated spectrum, or None if the spectrum is not
+        in the folder
+
+        Only the spectrum returned is checked on disk: if it is not indexed
+        or does not exist anymore, the index is updated from the folder
+        content (and saved, when possible) before looking it up again
+        """
+
+        file_name = self._lookup(ID, MC_draw, FWA, GWA, nexp)
+        if file_name is not None and os.path.isfile(file_name):
+            return file_name
+
+        self.update()
+        try:
+            self.save()
+        except (IOError, OSError):
+            pass
+
+        return self._lookup(ID, MC_draw, FWA, GWA, nexp)
+
+    def file_names(self):
+        """ Full path of all the spectra in the index, in natural order """
+
+        names = natsorted(set(self.entries.itervalues()))
+
+        return [os.path.join(self.folder, name) for name in names]
+
+    def load(self):
+
+        with open(self.file_name) as f:
+            entries = json.load(f)
+
+        for entry in entries:
+            self.add(entry["file"], nexp=entry["nexp"], ID=entry["ID"],
+                    MC_draw=entry["MC_draw"], FWA=entry["FWA"], GWA=entry["GWA"])
+
+    def save(self):
+
+        entries = list()
+        for (ID, MC_draw, FWA, GWA, nexp), name in self.entries.iteritems():
+            entries.append(OrderedDict([("ID", ID), ("MC_draw", MC_draw), ("FWA", FWA),
+                ("GWA", GWA), ("nexp", nexp), ("file", name)]))
+
+        # Write to a temporary file first and then rename it, so that readers
+        # never see a partially written index
+        tmp_file = self.file_name + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.rename(tmp_file, self.file_name)
+
+    def rebuild(self):
+        """
+        Rebuild the index by scanning the folder (the number of exposures of
+        the spectra is then unknown)
+        """
+
+        self.entries = OrderedDict()
+        self.configurations = dict()
+
+        for name in list_spectra(self.folder):
+            self.add(name)
+
+    def is_up_to_date(self):
+        """
+        Whether all the indexed spectra exist, and the folder does not
+        contain other spectra
+        """
+
+        names = set(self.entries.itervalues())
+        for name in names:
+            if not os.path.isfile(os.path.join(self.folder, name)):
+                return False
+
+        return len(names) == len(list_spectra(self.folder))
+
+    def update(self):
+        """
+        Remove the entries of the spectra which do not exist anymore, and add
+        the spectra of the folder which are not indexed (with unknown number
+        of exposures), keeping the other entries
+        """
+
+        entries = self.entries
+        self.entries = OrderedDict()
+        self.configurations = dict()
+
+        for (ID, MC_draw, FWA, GWA, nexp), name in entries.iteritems():
+            if os.path.isfile(os.path.join(self.folder, name)):
+                self.add(name, nexp=nexp, ID=ID, MC_draw=MC_draw, FWA=FWA, GWA=GWA)
+
+        names = set(self.entries.itervalues())
+        for name in list_spectra(self.folder):
+            if name not in names:
+                self.add(name)
+
+def list_spectra(folder):
+    """ Names of the simulated spectra (FITS files) of the folder """
+
+    return [name for name in natsorted(os.listdir(folder)) if name.endswith(".fits")]
+
+def get_simulations_index(folder, update=False):
+    """
+    Load the index of the ETC-output `folder`, building it from the folder
+    content if it does not exist yet. The index is otherwise trusted, so
+    that loading it does not scan the folder, unless `update` is True: the
+    index is then updated if it does not match the spectra in the folder
+    (as done by make_ETC_simulations.py after writing new spectra). The
+    index is saved, when possible, if it has been built or updated.
+    """
+
+    index = SimulationsIndex(folder)
+
+    if not os.path.isfile(index.file_name):
+        index.rebuild()
+    elif update and not index.is_up_to_date():
+        index.update()
+    else:
+        return index
+
+    try:
+        index.save()
+    except (IOError, OSError):
+        pass
+
+    return index
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--folder',
+        help="ETC-output folder(s) containing the simulated NIRSpec spectra",
+        dest="folders",
+        type=str,
+        nargs='+',
+        required=True
+    )
+
+    args = parser.parse_args()
+
+    for folder in args.folders:
+        index = SimulationsIndex(folder)
+        index.rebuild()
+        index.save()
+        print "Indexed ", len(index.entries), " spectra in ", folder